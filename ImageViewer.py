@@ -23,13 +23,2655 @@ SOFTWARE.
 '''
 
 
-from PySide2.QtWidgets import QOpenGLWidget, QUndoStack, QGraphicsScene, QGraphicsView, QGraphicsPixmapItem, QApplication, QWidget, QScrollArea, QAction, QLabel
-from PySide2.QtCore import QEvent, Signal, Slot, Qt, QPoint
-from PySide2.QtGui import QImage, QPixmap, QFont, QPainter, QPen, QCursor, QKeySequence
+import glob
+import hashlib
+import json
+import math
+import os
+import struct
+import tempfile
+import time
+import warnings
+from collections import OrderedDict, deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from PySide2.QtWidgets import QOpenGLWidget, QUndoStack, QUndoCommand, QGraphicsScene, QGraphicsView, QGraphicsItem, QGraphicsPixmapItem, QGraphicsRectItem, QGraphicsPathItem, QApplication, QWidget, QScrollArea, QAction, QLabel
+from PySide2.QtCore import QCoreApplication, QEvent, Signal, Slot, Qt, QPoint, QPointF, QRect, QRectF, QSize, QTimer, QStandardPaths, QByteArray, QBuffer, QFile, QIODevice, QObject, QRunnable, QThreadPool, qCompress, qUncompress
+from PySide2.QtGui import QGuiApplication, QOpenGLContext, QOpenGLShader, QOpenGLShaderProgram, QOpenGLBuffer, QOpenGLTexture, QMatrix4x4, QTransform, QPaintEngine, QColor, QImage, QImageReader, QImageWriter, QImageIOHandler, QPixmap, QFont, QPainter, QPainterPath, QPen, QCursor, QKeySequence
 import rc_resources
 
+GL_FLOAT = 0x1406
+GL_TRIANGLE_STRIP = 0x0005
+GL_TEXTURE0 = 0x84C0
+GL_BLEND = 0x0BE2
+GL_SRC_ALPHA = 0x0302
+GL_ONE_MINUS_SRC_ALPHA = 0x0303
+GL_MAX_TEXTURE_SIZE = 0x0D33
+
+
+class StrokeCommand(QUndoCommand):
+    '''
+    Undoable stroke on a TiledImageItem, keeping the compressed pixels of its
+    bounding rectangle before and after the stroke. Commands pushed for the same
+    stroke id are merged into one.
+    '''
+
+    def __init__(self, history, item, rect, before, after, bytesPerLine, imageFormat, strokeId):
+        super().__init__(QCoreApplication.translate("ImageViewer", "Stroke"))
+        self.history = history
+        self.item = item
+        self.rect = rect
+        self.before = before
+        self.after = after
+        self.bytesPerLine = bytesPerLine
+        self.format = imageFormat
+        self.strokeId = strokeId
+        # The stroke is already drawn when the command is pushed
+        self.applied = True
+
+    def cost(self):
+        return self.before.size() + self.after.size()
+
+    def restore(self, data):
+        image = QImage(qUncompress(data).data(), self.rect.width(), self.rect.height(),
+                       self.bytesPerLine, self.format).copy()
+        painter = QPainter(self.item.image())
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(self.rect.topLeft(), image)
+        painter.end()
+        self.item.updateRegion(self.rect)
+
+    def redo(self):
+        if self.applied or self.history.rebuilding:
+            self.applied = False
+            return
+        self.restore(self.after)
+
+    def undo(self):
+        if not self.history.rebuilding:
+            self.restore(self.before)
+
+    def id(self):
+        return 1
+
+    def mergeWith(self, other):
+        if not isinstance(other, StrokeCommand) or other.strokeId != self.strokeId:
+            return False
+        # Outside both rectangles the pixels are unchanged, the earlier command has the oldest pixels
+        rect = self.rect.united(other.rect)
+        before = self.item.image().copy(rect)
+        painter = QPainter(before)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for command in (other, self):
+            painter.drawImage(command.rect.topLeft() - rect.topLeft(), QImage(
+                qUncompress(command.before).data(), command.rect.width(), command.rect.height(),
+                command.bytesPerLine, command.format))
+        painter.end()
+        self.rect = rect
+        self.before = self.history.compress(before)
+        self.after = self.history.compress(self.item.image().copy(rect))
+        self.bytesPerLine = before.bytesPerLine()
+        return True
+
+    def clone(self):
+        return StrokeCommand(self.history, self.item, self.rect, self.before, self.after,
+                             self.bytesPerLine, self.format, self.strokeId)
+
+
+class AnnotationCommand(QUndoCommand):
+    '''
+    Undoable StrokeRecord added to an AnnotationLayer.
+    '''
+
+    def __init__(self, history, layer, record):
+        super().__init__(QCoreApplication.translate("ImageViewer", "Annotation"))
+        self.history = history
+        self.layer = layer
+        self.record = record
+
+    def cost(self):
+        return self.record.memoryUsage()
+
+    def redo(self):
+        if not self.history.rebuilding:
+            self.layer.addStroke(self.record)
+
+    def undo(self):
+        if not self.history.rebuilding:
+            self.layer.removeStroke(self.record)
+
+    def clone(self):
+        return AnnotationCommand(self.history, self.layer, self.record)
+
+
+class UndoHistory(QUndoStack):
+    '''
+    Command history of the strokes. Each stroke command only keeps the
+    compressed pixels covered by one stroke (press to release). When the memory
+    limit is reached the oldest commands are dropped first, the newest one is
+    always kept.
+    '''
+
+    def __init__(self, item, memoryLimit=64 * 1024 * 1024, compressionLevel=1, parent=None):
+        super().__init__(parent)
+        self.item = item
+        self.memoryLimit = memoryLimit
+        self.compressionLevel = compressionLevel
+        self.rebuilding = False
+        self.strokeRect = QRect()
+        self.strokeBackup = QImage()
+
+    @property
+    def memoryUsage(self):
+        return sum(self.command(index).cost() for index in range(self.count()))
+
+    def compress(self, image):
+        return qCompress(QByteArray(bytes(image.constBits())), self.compressionLevel)
+
+    def setMemoryLimit(self, memoryLimit):
+        '''
+        Set the maximum size in bytes of the compressed history.
+        '''
+        self.memoryLimit = memoryLimit
+        self.evict()
+
+    def beginStroke(self):
+        self.strokeRect = QRect()
+        self.strokeBackup = QImage()
+
+    def extendStroke(self, source, rect):
+        '''
+        Save the pixels of source (QPixmap or QImage) under rect that are not
+        saved yet for the current stroke. Must be called before painting in rect.
+        '''
+        rect = rect.intersected(source.rect())
+        if rect.isEmpty() or self.strokeRect.contains(rect):
+            return
+        united = self.strokeRect.united(rect)
+        backup = source.copy(united)
+        if isinstance(backup, QPixmap):
+            backup = backup.toImage()
+        if not self.strokeBackup.isNull():
+            # Pixels already covered by the stroke are only valid in the previous backup
+            painter = QPainter(backup)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(self.strokeRect.topLeft() -
+                              united.topLeft(), self.strokeBackup)
+            painter.end()
+        self.strokeRect = united
+        self.strokeBackup = backup
+
+    def endStroke(self, strokeId=0):
+        '''
+        Push the pixels saved for the current stroke and the painted ones as a command.
+        '''
+        if self.strokeBackup.isNull():
+            return
+        backup = self.strokeBackup
+        self.push(StrokeCommand(self, self.item, self.strokeRect, self.compress(backup),
+                                self.compress(self.item.image().copy(self.strokeRect)),
+                                backup.bytesPerLine(), backup.format(), strokeId))
+        self.beginStroke()
+        self.evict()
+
+    def pushAnnotation(self, layer, record):
+        self.push(AnnotationCommand(self, layer, record))
+        self.evict()
+
+    def evict(self):
+        '''
+        Drop the oldest applied commands until the history fits in the memory limit.
+        QUndoStack cannot remove its first commands, so the stack is rebuilt
+        with the kept ones, which are neither redone nor undone meanwhile.
+        '''
+        costs = [self.command(index).cost() for index in range(self.count())]
+        total = sum(costs)
+        first = 0
+        while total > self.memoryLimit and first < min(self.index(), self.count() - 1):
+            total -= costs[first]
+            first += 1
+        if first == 0:
+            return
+        index = self.index()
+        kept = [self.command(position).clone() for position in range(first, self.count())]
+        self.rebuilding = True
+        self.clear()
+        for command in kept:
+            self.push(command)
+        self.setIndex(index - first)
+        self.rebuilding = False
+
+
+def pyramidLevels(image, tileSize=512):
+    '''
+    Return the images of a 2x pyramid, halving image until it fits in one tile.
+    '''
+    levels = []
+    while not image.isNull() and max(image.width(), image.height()) > tileSize:
+        image = image.scaled(max(image.width() // 2, 1), max(image.height() // 2, 1),
+                             Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        levels.append(image)
+    return levels
+
+
+def pyramidSizes(size, tileSize=512):
+    '''
+    Return the sizes of the images returned by pyramidLevels for an image of size.
+    '''
+    sizes = []
+    while max(size.width(), size.height()) > tileSize:
+        size = QSize(max(size.width() // 2, 1), max(size.height() // 2, 1))
+        sizes.append(size)
+    return sizes
+
+
+def decimatedLevels(array, tileSize=512):
+    '''
+    Return the images of a 2x pyramid of an 8-bit array wrapped by arrayToImage,
+    keeping every other pixel. Only half of the rows of a memory-mapped file are read.
+    '''
+    levels = []
+    while max(array.shape[0], array.shape[1]) > tileSize:
+        array = numpy.ascontiguousarray(array[::2, ::2])
+        # The image must own its pixels once the array is released
+        levels.append(arrayToImage(array)[0].copy())
+    return levels
+
+
+class ImageTile(QGraphicsItem):
+    '''
+    Display tile owning its pixmap, so changed regions are painted in place
+    and only they are repainted, instead of replacing the whole pixmap.
+    '''
+
+    def __init__(self, image, parent=None):
+        '''
+        image is the pixels of the tile, or its size for a transparent tile.
+        '''
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        if isinstance(image, QSize):
+            self.tile = QPixmap(image)
+            self.tile.fill(Qt.transparent)
+        else:
+            self.tile = QPixmap.fromImage(image)
+        self.transformationMode = Qt.SmoothTransformation
+
+    def boundingRect(self):
+        return QRectF(self.tile.rect())
+
+    def paint(self, painter, option, widget=None):
+        painter.setRenderHint(QPainter.SmoothPixmapTransform,
+                              self.transformationMode == Qt.SmoothTransformation)
+        exposed = option.exposedRect.toAlignedRect().intersected(self.tile.rect())
+        painter.drawPixmap(exposed.topLeft(), self.tile, exposed)
+
+    def setTransformationMode(self, mode):
+        if mode != self.transformationMode:
+            self.transformationMode = mode
+            self.update()
+
+    def memoryUsage(self):
+        return self.tile.width() * self.tile.height() * self.tile.depth() // 8
+
+    def updateRegion(self, position, patch):
+        '''
+        Replace the pixels at position by patch.
+        '''
+        painter = QPainter(self.tile)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(position, patch)
+        painter.end()
+        self.update(QRectF(QRect(position, patch.size())))
+
+
+class SourceTile(QGraphicsItem):
+    '''
+    Full resolution level of a TiledImageItem drawn straight from its image,
+    for images wrapping external memory that tiles would copy entirely.
+    '''
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.transformationMode = Qt.SmoothTransformation
+
+    def boundingRect(self):
+        return QRectF(self.parentItem().source.rect())
+
+    def paint(self, painter, option, widget=None):
+        source = self.parentItem().source
+        painter.setRenderHint(QPainter.SmoothPixmapTransform,
+                              self.transformationMode == Qt.SmoothTransformation)
+        exposed = option.exposedRect.toAlignedRect().intersected(source.rect())
+        painter.drawImage(exposed.topLeft(), source, exposed)
+
+    def setTransformationMode(self, mode):
+        if mode != self.transformationMode:
+            self.transformationMode = mode
+            self.update()
+
+    def memoryUsage(self):
+        return 0
+
+
+class GLImageItem(QGraphicsItem):
+    '''
+    Image drawn with OpenGL from mipmapped textures no larger than the maximum
+    texture size. Zooming and panning only change the matrix uniform, and only
+    the textures of changed tiles are uploaded again. Without an OpenGL paint
+    engine the image is drawn with QPainter instead.
+    '''
+    vertexShader = '''
+        attribute highp vec2 position;
+        uniform highp mat4 matrix;
+        varying highp vec2 coordinates;
+        void main() {
+            coordinates = position;
+            gl_Position = matrix * vec4(position, 0.0, 1.0);
+        }'''
+    fragmentShader = '''
+        uniform sampler2D tile;
+        varying highp vec2 coordinates;
+        void main() {
+            gl_FragColor = texture2D(tile, coordinates);
+        }'''
+
+    def __init__(self, parent=None, maximumTileSize=4096):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.maximumTileSize = maximumTileSize
+        self.image = QImage()
+        self.tileSize = 0
+        self.textures = {}
+        self.dirty = set()
+        self.released = []
+        self.context = None
+        self.program = None
+        self.quad = None
+        self.transformationMode = Qt.SmoothTransformation
+
+    def boundingRect(self):
+        return QRectF(self.image.rect())
+
+    def setImage(self, image):
+        self.prepareGeometryChange()
+        self.image = image
+        # Textures can only be deleted with their context current, that is in paint
+        self.released += self.textures.values()
+        self.textures = {}
+        self.dirty = set()
+        self.update()
+
+    def setSource(self, image):
+        '''
+        Replace the image by one with the same pixels, without uploading it again.
+        '''
+        self.image = image
+
+    def tiles(self, rect):
+        if not self.tileSize:
+            return []
+        rect = rect.intersected(self.image.rect())
+        return [(column, row)
+                for row in range(rect.top() // self.tileSize, rect.bottom() // self.tileSize + 1)
+                for column in range(rect.left() // self.tileSize, rect.right() // self.tileSize + 1)
+                if not rect.isEmpty()]
+
+    def updateRegion(self, rect):
+        self.dirty.update(tile for tile in self.tiles(rect) if tile in self.textures)
+        self.update(QRectF(rect))
+
+    def setTransformationMode(self, mode):
+        self.transformationMode = mode
+        self.update()
+
+    def memoryUsage(self):
+        '''
+        Return an estimate of the texture memory, mipmaps included.
+        '''
+        return sum(texture.width() * texture.height() * 4 * 4 // 3
+                   for texture in self.textures.values())
+
+    def paint(self, painter, option, widget=None):
+        if self.image.isNull():
+            return
+        context = QOpenGLContext.currentContext()
+        if context is None or painter.paintEngine().type() != QPaintEngine.OpenGL2:
+            exposed = option.exposedRect.toAlignedRect().intersected(self.image.rect())
+            painter.drawImage(exposed.topLeft(), self.image, exposed)
+            return
+        painter.beginNativePainting()
+        try:
+            self.render(context, painter, option.exposedRect.toAlignedRect())
+        finally:
+            painter.endNativePainting()
+
+    def initialize(self, context):
+        # PySide2 writes the value into a buffer, 2048 is supported everywhere in practice
+        maximum = 2048
+        if numpy is not None:
+            value = numpy.zeros(1, numpy.int32)
+            context.functions().glGetIntegerv(GL_MAX_TEXTURE_SIZE, value)
+            maximum = int(value[0]) or maximum
+        self.tileSize = min(maximum, self.maximumTileSize)
+        self.program = QOpenGLShaderProgram()
+        self.program.addShaderFromSourceCode(QOpenGLShader.Vertex, self.vertexShader)
+        self.program.addShaderFromSourceCode(QOpenGLShader.Fragment, self.fragmentShader)
+        self.program.bindAttributeLocation("position", 0)
+        self.program.link()
+        self.quad = QOpenGLBuffer(QOpenGLBuffer.VertexBuffer)
+        self.quad.create()
+        self.quad.bind()
+        self.quad.allocate(struct.pack("8f", 0, 0, 1, 0, 0, 1, 1, 1), 32)
+        self.quad.release()
+        self.context = context
+        context.aboutToBeDestroyed.connect(self.releaseContext)
+
+    def releaseContext(self):
+        for texture in list(self.textures.values()) + self.released:
+            texture.destroy()
+        self.textures = {}
+        self.released = []
+        self.quad.destroy()
+        self.program = None
+        self.context = None
+
+    def render(self, context, painter, exposed):
+        if context is not self.context:
+            if self.context is not None:
+                # The textures of another context cannot be used here
+                self.textures = {}
+                self.released = []
+            self.initialize(context)
+        for texture in self.released:
+            texture.destroy()
+        self.released = []
+        functions = context.functions()
+        device = painter.device()
+        projection = QMatrix4x4()
+        projection.ortho(0, device.width(), device.height(), 0, -1, 1)
+        transform = painter.combinedTransform()
+        self.program.bind()
+        self.program.setUniformValue1i("tile", 0)
+        self.quad.bind()
+        self.program.enableAttributeArray(0)
+        self.program.setAttributeBuffer(0, GL_FLOAT, 0, 2, 0)
+        functions.glActiveTexture(GL_TEXTURE0)
+        functions.glEnable(GL_BLEND)
+        # QOpenGLTexture uploads QImage as non premultiplied RGBA
+        functions.glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        magnification = QOpenGLTexture.Linear if self.transformationMode == Qt.SmoothTransformation \
+            else QOpenGLTexture.Nearest
+        for column, row in self.tiles(exposed):
+            rect = QRect(column * self.tileSize, row * self.tileSize,
+                         self.tileSize, self.tileSize).intersected(self.image.rect())
+            texture = self.textures.get((column, row))
+            if texture is None or (column, row) in self.dirty:
+                if texture is not None:
+                    texture.destroy()
+                texture = QOpenGLTexture(self.image.copy(rect), QOpenGLTexture.GenerateMipMaps)
+                texture.setWrapMode(QOpenGLTexture.ClampToEdge)
+                self.textures[(column, row)] = texture
+                self.dirty.discard((column, row))
+            texture.setMinMagFilters(QOpenGLTexture.LinearMipMapLinear, magnification)
+            texture.bind()
+            # The unit quad scaled to the tile, then placed in the image and in the view
+            tileTransform = QTransform.fromScale(rect.width(), rect.height()) \
+                * QTransform.fromTranslate(rect.left(), rect.top()) * transform
+            with warnings.catch_warnings():
+                # PySide2 warns on each matrix uniform while it tries the C array overloads first
+                warnings.filterwarnings("ignore", r"SbkConverter: Unimplemented C\+\+ array type",
+                                        RuntimeWarning)
+                self.program.setUniformValue("matrix", projection * QMatrix4x4(tileTransform))
+            functions.glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+            texture.release()
+        self.program.disableAttributeArray(0)
+        self.quad.release()
+        self.program.release()
+
+
+class TiledImageItem(QGraphicsItem):
+    '''
+    Image displayed as a grid of tiles over a 2x pyramid of levels. Only the
+    level matching the current zoom is visible, and the scene only paints the
+    tiles intersecting the exposed area. The full resolution image is the
+    working buffer painted by the strokes, converted to premultiplied ARGB on
+    the first change, and only the changed regions are copied to the tiles.
+    An image wrapping external memory is drawn by a SourceTile at full
+    resolution, and its reduced levels are set apart with setLevels.
+    With setOpenGL, a GLImageItem draws the image instead of the tiles.
+    '''
+    workingFormat = QImage.Format_ARGB32_Premultiplied
+
+    def __init__(self, tileSize=512, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
+        self.tileSize = tileSize
+        self.source = QImage()
+        self.sourceData = None
+        self.levels = []
+        self.level = 0
+        self.blankSizes = []
+        self.pendingLevels = False
+        self.pendingRect = QRect()
+        self.transformationMode = Qt.SmoothTransformation
+        self.glItem = None
+        self.overviewPixmap = None
+
+    def boundingRect(self):
+        return QRectF(self.source.rect())
+
+    def overview(self):
+        '''
+        Return a pixmap of the whole image no larger than a tile. It is the
+        coarsest tile of the pyramid, or a scaled copy of the image refreshed
+        by updateRegion, so it follows the strokes.
+        '''
+        top = self.levels[-1] if self.levels else {}
+        if len(top) == 1 and isinstance(top[(0, 0)], ImageTile):
+            return top[(0, 0)].tile
+        if self.pendingLevels:
+            # Scaling the wrapped memory would read all of it
+            return QPixmap()
+        if self.overviewPixmap is None:
+            self.overviewPixmap = QPixmap() if self.source.isNull() else QPixmap.fromImage(
+                self.source.scaled(self.tileSize, self.tileSize, Qt.KeepAspectRatio,
+                                   Qt.SmoothTransformation))
+        return self.overviewPixmap
+
+    def setOpenGL(self, enabled):
+        '''
+        Draw the image with a GLImageItem instead of the pyramid of tiles.
+        '''
+        if enabled == (self.glItem is not None):
+            return
+        if enabled:
+            self.glItem = GLImageItem(self)
+            self.glItem.setTransformationMode(self.transformationMode)
+        else:
+            self.glItem.setParentItem(None)
+            if self.glItem.scene():
+                self.glItem.scene().removeItem(self.glItem)
+            self.glItem = None
+        self.setImage(self.source, self.sourceData)
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+    def image(self):
+        '''
+        Return the full resolution image. Call updateRegion after painting into it.
+        '''
+        if self.source.format() != self.workingFormat and not self.source.isNull():
+            # QPainter is fastest on premultiplied ARGB
+            self.source = self.source.convertToFormat(self.workingFormat)
+            self.sourceData = None
+        elif self.sourceData is not None:
+            # The image wraps memory that may be read only, it is copied before any change
+            self.source = self.source.copy()
+            self.sourceData = None
+        if self.glItem:
+            self.glItem.setSource(self.source)
+        return self.source
+
+    def isNull(self):
+        return self.source.isNull()
+
+    def memoryUsage(self):
+        '''
+        Return the bytes used by the tiles of every level, or by the textures.
+        '''
+        if self.glItem:
+            return self.glItem.memoryUsage()
+        return sum(tile.memoryUsage() for level in self.levels for tile in level.values())
+
+    def sourceMemoryUsage(self):
+        '''
+        Return the bytes of the full resolution image, 0 if it wraps external memory.
+        '''
+        return 0 if self.sourceData is not None else self.source.sizeInBytes()
+
+    def setImage(self, image, data=None, levels=None, blank=False):
+        '''
+        Set the image and build the tiles of every level. data is the object
+        owning the memory of image if any, it is kept alive while displayed.
+        levels are the reduced images of the pyramid, computed if None, unless
+        data is set: they are then expected from setLevels. With blank, image
+        is transparent and its tiles are only created by updateRegion.
+        Return the reduced images, levels unchanged in OpenGL mode.
+        '''
+        self.prepareGeometryChange()
+        self.sourceData = data
+        for level in self.levels:
+            for tile in level.values():
+                tile.setParentItem(None)
+                if self.scene():
+                    self.scene().removeItem(tile)
+        self.levels = []
+        self.blankSizes = []
+        self.pendingLevels = False
+        self.pendingRect = QRect()
+        # A handle of its own, painting then copies the pixels shared with the caller
+        self.source = QImage(image)
+        self.overviewPixmap = None
+        if self.glItem:
+            # Mipmaps replace the levels
+            self.glItem.setImage(image)
+            return levels
+        if data is not None and not image.isNull():
+            # Tiles would read and copy all the wrapped memory
+            self.levels.append({(0, 0): SourceTile(self)})
+            self.pendingLevels = levels is None
+            self.addLevels(levels or [], 2)
+        elif blank:
+            # Nothing to scale or copy, the tiles appear as the regions are painted
+            self.blankSizes = [image.size()] + pyramidSizes(image.size(), self.tileSize)
+            self.levels = [{} for size in self.blankSizes]
+        else:
+            if levels is None:
+                levels = pyramidLevels(image, self.tileSize)
+            self.addLevels([image] + levels if not image.isNull() else [], 1)
+        self.level = min(self.level, max(len(self.levels) - 1, 0))
+        for index, level in enumerate(self.levels):
+            for tile in level.values():
+                tile.setVisible(index == self.level)
+        return levels
+
+    def addLevels(self, images, scale):
+        '''
+        Append the tiles of images, the first one scale times smaller than the image.
+        '''
+        for levelImage in images:
+            tiles = {}
+            for row in range(math.ceil(levelImage.height() / self.tileSize)):
+                for column in range(math.ceil(levelImage.width() / self.tileSize)):
+                    tileRect = QRect(column * self.tileSize, row * self.tileSize,
+                                     self.tileSize, self.tileSize).intersected(levelImage.rect())
+                    tiles[(column, row)] = self.createTile(levelImage.copy(tileRect), column, row, scale)
+            self.levels.append(tiles)
+            scale *= 2
+
+    def createTile(self, image, column, row, scale):
+        tile = ImageTile(image, self)
+        tile.setPos(column * self.tileSize * scale,
+                    row * self.tileSize * scale)
+        tile.setScale(scale)
+        tile.setTransformationMode(self.transformationMode)
+        return tile
+
+    def setLevels(self, levels):
+        '''
+        Set the reduced images of an image wrapping external memory, computed
+        apart. The regions changed meanwhile are refreshed in them.
+        '''
+        if not self.pendingLevels:
+            return
+        self.pendingLevels = False
+        self.addLevels(levels, 2)
+        for level in self.levels[1:]:
+            for tile in level.values():
+                tile.setVisible(False)
+        if not self.pendingRect.isEmpty():
+            self.updateRegion(self.pendingRect)
+            self.pendingRect = QRect()
+
+    def setTransformationMode(self, mode):
+        '''
+        Set how the tiles are scaled, Qt.FastTransformation is cheaper while animating.
+        '''
+        self.transformationMode = mode
+        if self.glItem:
+            self.glItem.setTransformationMode(mode)
+        for level in self.levels:
+            for tile in level.values():
+                tile.setTransformationMode(mode)
+
+    def setZoom(self, zoom):
+        '''
+        Show the coarsest level that still has at least one pixel per screen pixel.
+        '''
+        level = min(max(int(math.floor(math.log2(1 / (zoom * self.scale())))), 0),
+                    max(len(self.levels) - 1, 0))
+        if level == self.level or not self.levels:
+            self.level = level
+            return
+        for tile in self.levels[self.level].values():
+            tile.setVisible(False)
+        for tile in self.levels[level].values():
+            tile.setVisible(True)
+        self.level = level
+
+    def updateRegion(self, rect):
+        '''
+        Refresh the tiles of every level covering rect from the full resolution image.
+        '''
+        rect = rect.intersected(self.source.rect())
+        if self.glItem:
+            self.glItem.updateRegion(rect)
+        if self.pendingLevels:
+            self.pendingRect = self.pendingRect.united(rect)
+        if self.overviewPixmap is not None and not self.overviewPixmap.isNull():
+            self.updateOverview(rect)
+        scale = 1
+        for index, level in enumerate(self.levels):
+            if isinstance(level.get((0, 0)), SourceTile):
+                # Drawn from the full resolution image, nothing to copy
+                level[(0, 0)].update(QRectF(rect))
+                scale *= 2
+                continue
+            # Align the region on the level pixels to avoid seams
+            left, top = rect.left() // scale, rect.top() // scale
+            right, bottom = rect.right() // scale, rect.bottom() // scale
+            for row in range(top // self.tileSize, bottom // self.tileSize + 1):
+                for column in range(left // self.tileSize, right // self.tileSize + 1):
+                    tileRect = QRect(column * self.tileSize, row * self.tileSize,
+                                     self.tileSize, self.tileSize)
+                    tile = level.get((column, row))
+                    size = tileRect.intersected(QRect(QPoint(), self.blankSizes[index])).size() \
+                        if tile is None and self.blankSizes else QSize()
+                    if not size.isEmpty():
+                        # First paint of a tile of a blank image
+                        tile = self.createTile(size, column, row, scale)
+                        tile.setVisible(index == self.level)
+                        level[(column, row)] = tile
+                    if tile is None:
+                        continue
+                    dirty = QRect(QPoint(left, top), QPoint(
+                        right, bottom)).intersected(tileRect)
+                    patch = self.source.copy(QRect(dirty.topLeft() * scale, dirty.size() * scale))
+                    if scale > 1:
+                        patch = patch.scaled(dirty.size(), Qt.IgnoreAspectRatio,
+                                             Qt.SmoothTransformation)
+                    tile.updateRegion(dirty.topLeft() - tileRect.topLeft(), patch)
+            scale *= 2
+
+    def updateOverview(self, rect):
+        '''
+        Scale again the part of the overview covering rect of the image.
+        '''
+        scaleX = self.overviewPixmap.width() / self.source.width()
+        scaleY = self.overviewPixmap.height() / self.source.height()
+        # Whole overview pixels, and the image pixels they cover
+        target = QRectF(rect.x() * scaleX, rect.y() * scaleY, rect.width() * scaleX,
+                        rect.height() * scaleY).toAlignedRect().intersected(self.overviewPixmap.rect())
+        covered = QRectF(target.x() / scaleX, target.y() / scaleY, target.width() / scaleX,
+                         target.height() / scaleY).toAlignedRect().intersected(self.source.rect())
+        if target.isEmpty() or covered.isEmpty():
+            return
+        painter = QPainter(self.overviewPixmap)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(target.topLeft(), self.source.copy(covered).scaled(
+            target.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        painter.end()
+
+
+class StrokeLayer(QGraphicsItem):
+    '''
+    Transparent layer above the image holding the stroke being drawn. Tiles are
+    allocated on demand and painting a segment only invalidates its bounding
+    rectangle. The layer is merged into the image with commit.
+    '''
+
+    def __init__(self, tileSize=256, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.tileSize = tileSize
+        self.bounds = QRect()
+        self.tiles = {}
+        self.dirtyRect = QRect()
+
+    def boundingRect(self):
+        return QRectF(self.bounds)
+
+    def setBounds(self, rect):
+        '''
+        Set the area that can be painted, usually the image rectangle.
+        '''
+        self.prepareGeometryChange()
+        self.clear()
+        self.bounds = rect
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect.toAlignedRect().intersected(self.dirtyRect)
+        for (column, row), tile in self.tiles.items():
+            position = QPoint(column * self.tileSize, row * self.tileSize)
+            if exposed.intersects(QRect(position, tile.size())):
+                painter.drawImage(position, tile)
+
+    def drawPath(self, path, pen):
+        '''
+        Draw a part of the stroke and return the updated rectangle.
+        '''
+        margin = pen.widthF() / 2 + 1
+        rect = path.controlPointRect().adjusted(-margin, -margin,
+                                                margin, margin).toAlignedRect().intersected(self.bounds)
+        if rect.isEmpty():
+            return rect
+        painter = QPainter()
+        for row in range(rect.top() // self.tileSize, rect.bottom() // self.tileSize + 1):
+            for column in range(rect.left() // self.tileSize, rect.right() // self.tileSize + 1):
+                tile = self.tiles.get((column, row))
+                if tile is None:
+                    tile = QImage(self.tileSize, self.tileSize,
+                                  QImage.Format_ARGB32_Premultiplied)
+                    tile.fill(Qt.transparent)
+                    self.tiles[(column, row)] = tile
+                painter.begin(tile)
+                painter.translate(-column * self.tileSize, -row * self.tileSize)
+                painter.setPen(pen)
+                painter.drawPath(path)
+                painter.end()
+        self.dirtyRect = self.dirtyRect.united(rect)
+        self.update(QRectF(rect))
+        return rect
+
+    def commit(self, image):
+        '''
+        Merge the layer into image, clear it and return the modified rectangle.
+        '''
+        rect = self.dirtyRect
+        painter = QPainter(image)
+        painter.setClipRect(rect)
+        for (column, row), tile in self.tiles.items():
+            painter.drawImage(column * self.tileSize, row * self.tileSize, tile)
+        painter.end()
+        self.clear()
+        return rect
+
+    def clear(self):
+        self.update(QRectF(self.dirtyRect))
+        self.tiles = {}
+        self.dirtyRect = QRect()
+
+    def memoryUsage(self):
+        return sum(tile.sizeInBytes() for tile in self.tiles.values())
+
+
+class StrokeRecord:
+    '''
+    Stroke kept as vector data: the mouse positions in image coordinates, the
+    pen width and color, and whether it is drawn as smoothed curves.
+    '''
+
+    def __init__(self, points, width, color, smooth=False):
+        self.points = [QPointF(point) for point in points]
+        self.width = width
+        self.color = QColor(color)
+        self.smooth = smooth
+
+    def path(self):
+        '''
+        Build the path the viewer drew for these points.
+        '''
+        points = self.points
+        path = QPainterPath(points[0])
+        if self.smooth:
+            for point, following in zip(points[1:], points[2:]):
+                path.quadTo(point, (point + following) / 2)
+            path.lineTo(points[-1])
+        else:
+            for point in points[1:]:
+                path.lineTo(point)
+        return path
+
+    def pen(self):
+        return QPen(self.color, self.width, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+
+    def memoryUsage(self):
+        return 16 * len(self.points)
+
+    def toDict(self):
+        return {"points": [[round(point.x(), 2), round(point.y(), 2)] for point in self.points],
+                "width": self.width, "color": self.color.name(QColor.HexArgb),
+                "smooth": self.smooth}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls([QPointF(x, y) for x, y in data["points"]], data["width"],
+                   QColor(data["color"]), data.get("smooth", False))
+
+
+class AnnotationLayer(QGraphicsItem):
+    '''
+    Strokes kept as StrokeRecord above the image, without changing its pixels.
+    Each stroke is a path item cached in device coordinates, so it is only
+    rasterized again for the exposed parts when the zoom changes. The strokes
+    can be saved to and loaded from JSON.
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemHasNoContents)
+        self.records = []
+        self.items = []
+
+    def boundingRect(self):
+        return QRectF()
+
+    def paint(self, painter, option, widget=None):
+        pass
+
+    def addStroke(self, record):
+        if len(record.points) < 1:
+            return
+        item = QGraphicsPathItem(record.path(), self)
+        item.setPen(record.pen())
+        item.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self.records.append(record)
+        self.items.append(item)
+
+    def removeStroke(self, record):
+        if record not in self.records:
+            return
+        item = self.items.pop(self.records.index(record))
+        self.records.remove(record)
+        item.setParentItem(None)
+        if item.scene():
+            item.scene().removeItem(item)
+
+    def clear(self):
+        for record in list(self.records):
+            self.removeStroke(record)
+
+    def memoryUsage(self):
+        return sum(record.memoryUsage() for record in self.records)
+
+    def render(self, image):
+        '''
+        Draw the strokes into image, for instance a transparent one to export them alone.
+        '''
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        for record in self.records:
+            painter.setPen(record.pen())
+            painter.drawPath(record.path())
+        painter.end()
+
+    def save(self, path, imagePath="", size=QSize()):
+        with open(path, "w") as file:
+            json.dump({"version": 1, "image": os.path.basename(imagePath),
+                       "size": [size.width(), size.height()],
+                       "strokes": [record.toDict() for record in self.records]}, file)
+
+    def load(self, path):
+        '''
+        Replace the strokes by those of a file written by save.
+        '''
+        with open(path) as file:
+            data = json.load(file)
+        self.clear()
+        for stroke in data.get("strokes", []):
+            self.addStroke(StrokeRecord.fromDict(stroke))
+
+
+class BrushCursorCache:
+    '''
+    Brush cursors memoized by size bucket, the sizes being quantized on a
+    geometric scale. Sizes above maximumSize, which most platforms cannot
+    display, have no cursor and the brush outline is drawn by the view instead.
+    '''
+
+    def __init__(self, pixmap, maxEntries=32, maximumSize=128, step=1.1):
+        self.pixmap = pixmap
+        self.maxEntries = maxEntries
+        self.maximumSize = maximumSize
+        self.step = step
+        self.entries = OrderedDict()
+
+    def bucket(self, size):
+        return max(int(round(self.step ** round(math.log(max(size, 1), self.step)))), 1)
+
+    def cursor(self, size):
+        '''
+        Return the cursor for a brush of size pixels on screen, None if too large.
+        '''
+        size = self.bucket(size)
+        if size > self.maximumSize:
+            return None
+        cursor = self.entries.get(size)
+        if cursor is None:
+            cursor = QCursor(self.pixmap.scaledToHeight(
+                size, Qt.SmoothTransformation))
+            self.entries[size] = cursor
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(size)
+        return cursor
+
+
+def frameInterval():
+    '''
+    Return the display frame period of the primary screen in milliseconds, 16 if unknown.
+    '''
+    screen = QGuiApplication.primaryScreen()
+    return int(1000 / screen.refreshRate()) if screen and screen.refreshRate() > 0 else 16
+
+
+class ZoomController(QObject):
+    '''
+    Zoom a view by easing towards a target zoom at the display refresh rate.
+    Wheel deltas, including high resolution pixel deltas, accumulate in the
+    target. The animating signal allows to render faster while zooming.
+    '''
+    zoomChanged = Signal(float)
+    animating = Signal(bool)
+
+    def __init__(self, view, minimum=0.01, maximum=64, notchFactor=1.25, easing=0.35):
+        super().__init__(view)
+        self.view = view
+        self.minimum = minimum
+        self.maximum = maximum
+        self.notchFactor = notchFactor
+        self.easing = easing
+        self.zoom = 1
+        self.target = 1
+        self.anchor = None
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.step)
+        self.timer.setInterval(frameInterval())
+
+    def setRange(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.zoomTo(self.target)
+
+    def wheel(self, event):
+        '''
+        Add the delta of a wheel event to the target zoom, around the cursor.
+        '''
+        if not event.pixelDelta().isNull():
+            # Trackpads report pixels, about 120 for a notch
+            steps = event.pixelDelta().y() / 120
+        else:
+            steps = event.angleDelta().y() / 120
+        self.zoomTo(self.target * self.notchFactor ** steps, anchor=event.posF())
+
+    def zoomTo(self, zoom, animated=True, anchor=None):
+        '''
+        Zoom around the view center, or keeping the scene point under the
+        viewport position anchor in place.
+        '''
+        self.anchor = None
+        if anchor is not None:
+            self.anchor = (self.view.viewportTransform().inverted()[0].map(anchor), anchor)
+        self.target = min(max(zoom, self.minimum), self.maximum)
+        if not animated:
+            self.timer.stop()
+            self.apply(self.target)
+            self.animating.emit(False)
+        elif not self.timer.isActive() and self.target != self.zoom:
+            self.animating.emit(True)
+            self.timer.start()
+
+    def zoomToFit(self, animated=True):
+        '''
+        Zoom to show the whole scene rect in the viewport.
+        '''
+        self.view.navigation.fitInView(self.view.sceneRect(), animated)
+
+    def zoomActualSize(self, animated=True):
+        '''
+        Zoom to display one image pixel per screen pixel.
+        '''
+        self.zoomTo(1, animated)
+
+    def step(self):
+        ratio = self.target / self.zoom
+        if abs(math.log(ratio)) < 0.002:
+            self.timer.stop()
+            self.apply(self.target)
+            self.animating.emit(False)
+        else:
+            self.apply(self.zoom * ratio ** self.easing)
+
+    def apply(self, zoom):
+        factor = zoom / self.zoom
+        self.zoom = zoom
+        if factor != 1:
+            self.view.scale(factor, factor)
+            if self.anchor is not None:
+                # Computed from the exact anchor each step, so rounding does not drift
+                scenePoint, position = self.anchor
+                offset = self.view.viewportTransform().map(scenePoint) - position
+                self.view.navigation.panBy(round(offset.x()), round(offset.y()))
+            self.zoomChanged.emit(zoom)
+
+
+class NavigationController(QObject):
+    '''
+    Pan and animated moves of a view. A pan scrolls the viewport once per event
+    whatever the number of scroll bars changed, a drag released while moving
+    goes on with a decreasing speed, and centerOn and fitInView ease towards
+    their target at the display refresh rate.
+    '''
+
+    def __init__(self, view, friction=0.03, minimumSpeed=20, duration=0.25):
+        super().__init__(view)
+        self.view = view
+        self.friction = friction
+        self.minimumSpeed = minimumSpeed
+        self.duration = duration
+        self.dragPosition = None
+        self.samples = deque(maxlen=8)
+        self.velocity = QPointF()
+        self.remainder = QPointF()
+        self.animation = None
+        self.lastStep = 0
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.step)
+        self.timer.setInterval(frameInterval())
+
+    def panBy(self, dx, dy):
+        '''
+        Scroll the view by dx, dy viewport pixels with a single viewport scroll.
+        '''
+        view = self.view
+        view.scrollBatch = QPoint()
+        try:
+            view.horizontalScrollBar().setValue(view.horizontalScrollBar().value() + dx)
+            view.verticalScrollBar().setValue(view.verticalScrollBar().value() + dy)
+        finally:
+            batch, view.scrollBatch = view.scrollBatch, None
+        if not batch.isNull():
+            QGraphicsView.scrollContentsBy(view, batch.x(), batch.y())
+
+    def beginDrag(self, position):
+        self.stop()
+        self.dragPosition = position
+        self.samples.clear()
+        self.samples.append((time.perf_counter(), position))
+
+    def drag(self, position):
+        if self.dragPosition is None:
+            self.beginDrag(position)
+            return
+        delta = self.dragPosition - position
+        self.dragPosition = position
+        self.samples.append((time.perf_counter(), position))
+        self.panBy(delta.x(), delta.y())
+
+    def endDrag(self):
+        '''
+        Keep panning with the speed of the last 100 ms of the drag.
+        '''
+        now = time.perf_counter()
+        recent = [(moment, position) for moment, position in self.samples if now - moment < 0.1]
+        self.dragPosition = None
+        if len(recent) < 2 or recent[-1][0] == recent[0][0]:
+            return
+        elapsed = recent[-1][0] - recent[0][0]
+        self.velocity = QPointF(recent[0][1] - recent[-1][1]) / elapsed
+        if math.hypot(self.velocity.x(), self.velocity.y()) > self.minimumSpeed:
+            self.remainder = QPointF()
+            self.start()
+
+    def centerOn(self, point, zoom=None, animated=True):
+        '''
+        Move the view center to the scene point, zooming to zoom if not None.
+        '''
+        self.stop()
+        zoomController = self.view.zoomController
+        zoom = zoomController.zoom if zoom is None else \
+            min(max(zoom, zoomController.minimum), zoomController.maximum)
+        zoomController.timer.stop()
+        zoomController.anchor = None
+        zoomController.target = zoom
+        if not animated:
+            zoomController.apply(zoom)
+            self.view.centerOn(point)
+            return
+        start = self.view.mapToScene(self.view.viewport().rect().center())
+        self.animation = (time.perf_counter(), QPointF(start), zoomController.zoom,
+                          QPointF(point), zoom)
+        self.start()
+
+    def fitInView(self, rect, animated=True):
+        '''
+        Zoom and center to show rect, in scene coordinates, in the viewport.
+        '''
+        if rect.isEmpty():
+            return
+        viewport = self.view.viewport().size()
+        self.centerOn(rect.center(), min(viewport.width() / rect.width(),
+                                         viewport.height() / rect.height()), animated)
+
+    def start(self):
+        self.lastStep = time.perf_counter()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.animation = None
+        self.velocity = QPointF()
+
+    def isMoving(self):
+        return self.timer.isActive()
+
+    def step(self):
+        now = time.perf_counter()
+        elapsed, self.lastStep = now - self.lastStep, now
+        self.view.renderPolicy.interact()
+        if self.animation:
+            startTime, start, startZoom, target, zoom = self.animation
+            progress = min((now - startTime) / self.duration, 1)
+            eased = 1 - (1 - progress) ** 3
+            self.view.zoomController.apply(startZoom * (zoom / startZoom) ** eased)
+            self.view.centerOn(start + (target - start) * eased)
+            if progress == 1:
+                self.stop()
+            return
+        # Sub-pixel moves are accumulated so slow ends stay smooth
+        move = self.velocity * elapsed + self.remainder
+        dx, dy = round(move.x()), round(move.y())
+        self.remainder = move - QPointF(dx, dy)
+        self.panBy(dx, dy)
+        self.velocity *= self.friction ** elapsed
+        if math.hypot(self.velocity.x(), self.velocity.y()) < self.minimumSpeed:
+            self.stop()
+
+
+class RenderPolicy(QObject):
+    '''
+    Render quality of a view: fast while the user pans, zooms or draws, then a
+    single smooth render once nothing happened for the idle timeout. The
+    presets are "quality" (always smooth), "balanced" and "speed" (always fast).
+    '''
+    # Fast rendering while interacting, milliseconds before the smooth render (None: never)
+    presets = {"quality": (False, 0),
+               "balanced": (True, 150),
+               "speed": (True, None)}
+
+    def __init__(self, view, mode="balanced"):
+        super().__init__(view)
+        self.view = view
+        self.fast = False
+        self.animating = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.settle)
+        self.setMode(mode)
+
+    def setMode(self, mode):
+        self.mode = mode
+        self.interactive, self.idleTimeout = self.presets[mode]
+        self.timer.stop()
+        self.fast = self.interactive and self.idleTimeout is None
+        self.view.setFastRendering(self.fast)
+
+    def setIdleTimeout(self, timeout):
+        '''
+        Set the milliseconds without interaction before the smooth render.
+        '''
+        self.idleTimeout = timeout
+
+    def interact(self):
+        '''
+        Render fast until the interactions stop.
+        '''
+        if not self.interactive:
+            return
+        if not self.fast:
+            self.fast = True
+            self.view.setFastRendering(True)
+        if self.idleTimeout is not None and not self.animating:
+            self.timer.start(self.idleTimeout)
+
+    @Slot(bool)
+    def setAnimating(self, animating):
+        self.animating = animating
+        if animating:
+            self.timer.stop()
+        self.interact()
+
+    def settle(self):
+        if self.fast and not self.animating:
+            self.fast = False
+            self.view.setFastRendering(False)
+
+
+class ViewerStats(QObject):
+    '''
+    Paint time and input to paint latency of a viewer over the last frames.
+    The updated signal sends a snapshot every interval milliseconds.
+    '''
+    updated = Signal(dict)
+
+    def __init__(self, viewer, window=240, interval=1000):
+        super().__init__(viewer)
+        self.viewer = viewer
+        self.frameTimes = deque(maxlen=window)
+        self.latencies = {"mouseMove": deque(maxlen=window),
+                          "wheel": deque(maxlen=window)}
+        self.pendingInputs = {}
+        self.frames = 0
+        self.lastFrames = 0
+        self.lastTime = time.perf_counter()
+        self.current = {}
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update)
+        self.timer.start(interval)
+
+    def inputReceived(self, kind):
+        # Only the oldest input not painted yet matters
+        self.pendingInputs.setdefault(kind, time.perf_counter())
+
+    def framePainted(self, start, end):
+        self.frames += 1
+        self.frameTimes.append(end - start)
+        for kind, received in self.pendingInputs.items():
+            self.latencies[kind].append(end - received)
+        self.pendingInputs.clear()
+
+    @staticmethod
+    def summary(samples):
+        if not samples:
+            return {"mean_ms": 0, "p95_ms": 0, "max_ms": 0}
+        ordered = sorted(samples)
+        return {"mean_ms": sum(ordered) / len(ordered) * 1000,
+                "p95_ms": ordered[math.ceil(len(ordered) * 0.95) - 1] * 1000,
+                "max_ms": ordered[-1] * 1000}
+
+    def update(self):
+        now = time.perf_counter()
+        viewer = self.viewer
+        self.current = {
+            "fps": (self.frames - self.lastFrames) / (now - self.lastTime),
+            "frames": self.frames,
+            "paint": self.summary(self.frameTimes),
+            "mouseMoveLatency": self.summary(self.latencies["mouseMove"]),
+            "wheelLatency": self.summary(self.latencies["wheel"]),
+            "cacheBytes": viewer.imageCache.bytes,
+            "imageBytes": viewer.image.sourceMemoryUsage(),
+            "textureBytes": viewer.image.memoryUsage(),
+            "strokeLayerBytes": viewer.strokeLayer.memoryUsage(),
+            "undoBytes": viewer.undoHistory.memoryUsage}
+        self.lastFrames = self.frames
+        self.lastTime = now
+        self.updated.emit(self.current)
+
+    def lines(self):
+        '''
+        Return the current snapshot as text lines for the HUD.
+        '''
+        if not self.current:
+            return []
+        stats = self.current
+        megabytes = 1024 * 1024
+        return ["{:.0f} fps, paint {:.1f} ms (max {:.1f})".format(
+                    stats["fps"], stats["paint"]["mean_ms"], stats["paint"]["max_ms"]),
+                "stroke latency {:.1f} ms (p95 {:.1f})".format(
+                    stats["mouseMoveLatency"]["mean_ms"], stats["mouseMoveLatency"]["p95_ms"]),
+                "zoom latency {:.1f} ms (p95 {:.1f})".format(
+                    stats["wheelLatency"]["mean_ms"], stats["wheelLatency"]["p95_ms"]),
+                "image {:.0f} MB, tiles {:.0f} MB, cache {:.0f} MB".format(
+                    stats["imageBytes"] / megabytes, stats["textureBytes"] / megabytes,
+                    stats["cacheBytes"] / megabytes),
+                "stroke {:.1f} MB, undo {:.1f} MB".format(
+                    stats["strokeLayerBytes"] / megabytes, stats["undoBytes"] / megabytes)]
+
+
+class _LoadSignals(QObject):
+    progress = Signal(int, int)
+    previewLoaded = Signal(int, QImage, QSize)
+    stripeLoaded = Signal(int, QRect, QImage, QSize)
+    progressiveLoaded = Signal(int)
+    reducedLoaded = Signal(int, QImage, QSize)
+    regionLoaded = Signal(int, QRect, QImage)
+    loaded = Signal(int, QImage, list)
+    failed = Signal(int, str)
+    finished = Signal(int)
+
+
+def readImageRegion(path, rect, scale=1.0):
+    '''
+    Decode only rect of an image, at a reduced scale if lower than 1. Formats
+    supporting clip and scaled reads (e.g. JPEG) avoid decoding the rest.
+    '''
+    reader = QImageReader(path)
+    reader.setClipRect(rect)
+    if scale != 1:
+        reader.setScaledSize(QSize(max(round(rect.width() * scale), 1),
+                                   max(round(rect.height() * scale), 1)))
+    return reader.read()
+
+
+class _LoadTask(QRunnable):
+    '''
+    Read and decode one image file in a worker thread. When progressive,
+    formats supporting clip reads are decoded in stripes from the top, each
+    stripe twice as high as the previous one. Decoding rows again before each
+    stripe then costs at most twice a plain decode. With a fitSize, formats
+    supporting scaled reads are only decoded at the size needed to fit in it.
+    With a tileSize, the pyramid levels of the full image are computed here
+    too and sent with it, so the GUI thread only converts tiles to pixmaps.
+    With a diskCache, the levels are read from it, or stored in it once computed.
+    '''
+    chunkSize = 4 * 1024 * 1024
+
+    def __init__(self, generation, path, previewSize, progressive=False, stripeHeight=256, fitSize=None,
+                 tileSize=0, diskCache=None):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.generation = generation
+        self.path = path
+        self.previewSize = previewSize
+        self.progressive = progressive
+        self.stripeHeight = stripeHeight
+        self.fitSize = fitSize
+        self.tileSize = tileSize
+        self.diskCache = diskCache
+        self.cancelled = False
+        self.signals = _LoadSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            self.decode()
+        finally:
+            self.signals.finished.emit(self.generation)
+
+    def decode(self):
+        file = QFile(self.path)
+        if not file.open(QIODevice.ReadOnly):
+            self.signals.failed.emit(self.generation, file.errorString())
+            return
+        # Read by chunks to report progress and react quickly to cancellation
+        data = QByteArray()
+        fileSize = max(file.size(), 1)
+        readShare = 50 if self.progressive else 90
+        while not file.atEnd():
+            if self.cancelled:
+                return
+            data.append(file.read(self.chunkSize))
+            self.signals.progress.emit(
+                self.generation, readShare * data.size() // fileSize)
+        file.close()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+        size = reader.size()
+        scale = min(self.fitSize.width() / size.width(), self.fitSize.height() / size.height()) \
+            if self.fitSize and not size.isEmpty() else 1
+        if scale < 1 and reader.supportsOption(QImageIOHandler.ScaledSize):
+            reader.setScaledSize(size * scale)
+            image = reader.read()
+            if self.cancelled:
+                return
+            if image.isNull():
+                self.signals.failed.emit(self.generation, reader.errorString())
+            else:
+                self.signals.progress.emit(self.generation, 100)
+                self.signals.reducedLoaded.emit(self.generation, image, size)
+            return
+        # Only formats able to decode at a reduced size (e.g. JPEG) make a cheap preview
+        if self.previewSize and reader.supportsOption(QImageIOHandler.ScaledSize) \
+                and max(size.width(), size.height()) > self.previewSize:
+            reader.setScaledSize(size.scaled(
+                self.previewSize, self.previewSize, Qt.KeepAspectRatio))
+            preview = reader.read()
+            if self.cancelled:
+                return
+            if not preview.isNull():
+                self.signals.previewLoaded.emit(
+                    self.generation, preview, size)
+            buffer.seek(0)
+            reader = QImageReader(buffer)
+        if self.progressive and reader.supportsOption(QImageIOHandler.ClipRect) and size.isValid():
+            self.decodeStripes(buffer, size)
+            return
+        image = reader.read()
+        if self.cancelled:
+            return
+        if image.isNull():
+            self.signals.failed.emit(self.generation, reader.errorString())
+            return
+        levels = self.pyramid(image) if self.tileSize else []
+        if self.cancelled:
+            return
+        self.signals.progress.emit(self.generation, 100)
+        self.signals.loaded.emit(self.generation, image, levels)
+
+    def pyramid(self, image):
+        if self.diskCache:
+            size, levels = self.diskCache.load(self.path)
+            if levels and size == image.size():
+                return levels
+        levels = pyramidLevels(image, self.tileSize)
+        if self.diskCache and levels:
+            # Stored apart so the load finishes first
+            QThreadPool.globalInstance().start(_StoreTask(self.diskCache, self.path, image, levels))
+        return levels
+
+    def decodeStripes(self, buffer, size):
+        top = 0
+        height = self.stripeHeight
+        while top < size.height():
+            rect = QRect(0, top, size.width(), min(height, size.height() - top))
+            buffer.seek(0)
+            reader = QImageReader(buffer)
+            reader.setClipRect(rect)
+            stripe = reader.read()
+            if self.cancelled:
+                return
+            if stripe.isNull():
+                self.signals.failed.emit(self.generation, reader.errorString())
+                return
+            self.signals.stripeLoaded.emit(self.generation, rect, stripe, size)
+            self.signals.progress.emit(
+                self.generation, 50 + 50 * rect.bottom() // size.height())
+            top += height
+            height *= 2
+        self.signals.progress.emit(self.generation, 100)
+        self.signals.progressiveLoaded.emit(self.generation)
+
+
+class _RegionTask(QRunnable):
+    '''
+    Decode a region of an image at a reduced scale in a worker thread.
+    '''
+
+    def __init__(self, generation, path, rect, scale):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.generation = generation
+        self.path = path
+        self.rect = rect
+        self.scale = scale
+        self.signals = _LoadSignals()
+
+    def cancel(self):
+        pass
+
+    def run(self):
+        try:
+            image = readImageRegion(self.path, self.rect, self.scale)
+            if not image.isNull():
+                self.signals.regionLoaded.emit(
+                    self.generation, self.rect, image)
+        finally:
+            self.signals.finished.emit(self.generation)
+
+
+class _LevelsTask(QRunnable):
+    '''
+    Compute the pyramid levels of an array in a worker thread, see decimatedLevels.
+    '''
+
+    def __init__(self, generation, array, tileSize):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.generation = generation
+        self.array = array
+        self.tileSize = tileSize
+        self.signals = _LoadSignals()
+
+    def run(self):
+        try:
+            self.signals.loaded.emit(self.generation, QImage(),
+                                     decimatedLevels(self.array, self.tileSize))
+        finally:
+            self.signals.finished.emit(self.generation)
+
+
+class ImageLoader(QObject):
+    '''
+    Decode images in a thread pool. Starting a load cancels the one in flight.
+    Signals are emitted in the thread of the loader, with QImage only, the
+    conversion to QPixmap is left to the GUI thread. loaded also sends the
+    pyramid levels of the image for tiles of tileSize. In progressive mode,
+    stripeLoaded is emitted for each stripe then progressiveLoaded instead of
+    loaded, for the formats supporting it.
+    '''
+    progress = Signal(str, int)
+    previewLoaded = Signal(str, QImage, QSize)
+    stripeLoaded = Signal(str, QRect, QImage, QSize)
+    progressiveLoaded = Signal(str)
+    reducedLoaded = Signal(str, QImage, QSize)
+    regionLoaded = Signal(str, QRect, QImage)
+    levelsLoaded = Signal(list)
+    loaded = Signal(str, QImage, list)
+    failed = Signal(str, str)
+
+    def __init__(self, parent=None, previewSize=1024, tileSize=512):
+        super().__init__(parent)
+        self.threadPool = QThreadPool(self)
+        self.previewSize = previewSize
+        self.tileSize = tileSize
+        self.diskCache = None
+        self.progressive = False
+        self.stripeHeight = 256
+        self.generation = 0
+        self.path = ""
+        self.tasks = {}
+        self.regionGeneration = 0
+        self.regionPath = ""
+        self.regionTasks = {}
+        self.levelsGeneration = 0
+        self.levelsTasks = {}
+
+    def load(self, path, fitSize=None):
+        '''
+        Start decoding path, the previous load is cancelled. With fitSize, the
+        image may be decoded at the size fitting in it and sent with reducedLoaded.
+        '''
+        self.cancel()
+        self.generation += 1
+        self.path = path
+        task = _LoadTask(self.generation, path, self.previewSize,
+                         self.progressive, self.stripeHeight, fitSize, self.tileSize, self.diskCache)
+        task.signals.reducedLoaded.connect(self.onReducedLoaded)
+        task.signals.progress.connect(self.onProgress)
+        task.signals.previewLoaded.connect(self.onPreviewLoaded)
+        task.signals.stripeLoaded.connect(self.onStripeLoaded)
+        task.signals.progressiveLoaded.connect(self.onProgressiveLoaded)
+        task.signals.loaded.connect(self.onLoaded)
+        task.signals.failed.connect(self.onFailed)
+        task.signals.finished.connect(self.onFinished)
+        # Tasks are kept alive until they leave the thread pool
+        self.tasks[self.generation] = task
+        self.threadPool.start(task)
+
+    def cancel(self):
+        '''
+        Cancel the load in flight, if any.
+        '''
+        task = self.tasks.get(self.generation)
+        if task:
+            task.cancel()
+            if self.threadPool.tryTake(task):
+                del self.tasks[self.generation]
+        self.generation += 1
+        self.levelsGeneration += 1
+
+    def loadRegion(self, path, rect, scale):
+        '''
+        Decode rect of path at scale, the previous region load is cancelled if not started.
+        '''
+        task = self.regionTasks.get(self.regionGeneration)
+        if task and self.threadPool.tryTake(task):
+            del self.regionTasks[self.regionGeneration]
+        self.regionGeneration += 1
+        self.regionPath = path
+        task = _RegionTask(self.regionGeneration, path, rect, scale)
+        task.signals.regionLoaded.connect(self.onRegionLoaded)
+        task.signals.finished.connect(self.onRegionFinished)
+        self.regionTasks[self.regionGeneration] = task
+        self.threadPool.start(task)
+
+    def loadLevels(self, array):
+        '''
+        Compute the pyramid levels of an 8-bit array for tiles of tileSize,
+        sent with levelsLoaded. Loading an image cancels them.
+        '''
+        self.levelsGeneration += 1
+        task = _LevelsTask(self.levelsGeneration, array, self.tileSize)
+        task.signals.loaded.connect(self.onLevelsLoaded)
+        task.signals.finished.connect(self.onLevelsFinished)
+        self.levelsTasks[self.levelsGeneration] = task
+        self.threadPool.start(task)
+
+    def setProgressive(self, progressive, stripeHeight=256):
+        '''
+        Decode the next loads by stripes from the top, the first one being stripeHeight rows.
+        '''
+        self.progressive = progressive
+        self.stripeHeight = stripeHeight
+
+    def isLoading(self):
+        return self.generation in self.tasks
+
+    @Slot(int, int)
+    def onProgress(self, generation, value):
+        if generation == self.generation:
+            self.progress.emit(self.path, value)
+
+    @Slot(int, QImage, QSize)
+    def onPreviewLoaded(self, generation, preview, size):
+        if generation == self.generation:
+            self.previewLoaded.emit(self.path, preview, size)
+
+    @Slot(int, QRect, QImage, QSize)
+    def onStripeLoaded(self, generation, rect, stripe, size):
+        if generation == self.generation:
+            self.stripeLoaded.emit(self.path, rect, stripe, size)
+
+    @Slot(int)
+    def onProgressiveLoaded(self, generation):
+        if generation == self.generation:
+            self.progressiveLoaded.emit(self.path)
+
+    @Slot(int, QImage, QSize)
+    def onReducedLoaded(self, generation, image, size):
+        if generation == self.generation:
+            self.reducedLoaded.emit(self.path, image, size)
+
+    @Slot(int, QRect, QImage)
+    def onRegionLoaded(self, generation, rect, image):
+        if generation == self.regionGeneration:
+            self.regionLoaded.emit(self.regionPath, rect, image)
+
+    @Slot(int)
+    def onRegionFinished(self, generation):
+        self.regionTasks.pop(generation, None)
+
+    @Slot(int, QImage, list)
+    def onLevelsLoaded(self, generation, image, levels):
+        if generation == self.levelsGeneration:
+            self.levelsLoaded.emit(levels)
+
+    @Slot(int)
+    def onLevelsFinished(self, generation):
+        self.levelsTasks.pop(generation, None)
+
+    @Slot(int, QImage, list)
+    def onLoaded(self, generation, image, levels):
+        if generation == self.generation:
+            self.loaded.emit(self.path, image, levels)
+
+    @Slot(int, str)
+    def onFailed(self, generation, error):
+        if generation == self.generation:
+            self.failed.emit(self.path, error)
+
+    @Slot(int)
+    def onFinished(self, generation):
+        self.tasks.pop(generation, None)
+
+
+class ImageCache:
+    '''
+    LRU cache of decoded images with a byte budget. Entries are keyed by
+    path, modification time and file size, so an edited file is decoded again.
+    The pyramid levels of an image can be kept with it, they count in the budget.
+    '''
+
+    def __init__(self, maxBytes=512 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        return os.path.abspath(path), info.st_mtime_ns, info.st_size
+
+    def contains(self, path):
+        '''
+        Return True if path is cached, without counting a hit or a miss.
+        '''
+        return self.key(path) in self.entries
+
+    def touch(self, path):
+        '''
+        Mark path as the most recently used entry, without counting a hit.
+        Return True if it is cached.
+        '''
+        key = self.key(path)
+        if key not in self.entries:
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    @staticmethod
+    def entryBytes(entry):
+        image, levels = entry
+        return image.sizeInBytes() + sum(level.sizeInBytes() for level in levels or [])
+
+    def get(self, path):
+        '''
+        Return the cached image of path, None if missing or outdated.
+        '''
+        key = self.key(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def levels(self, path):
+        '''
+        Return the pyramid levels cached with the image of path, None if unknown.
+        '''
+        entry = self.entries.get(self.key(path))
+        return entry[1] if entry is not None else None
+
+    def entrySize(self, path):
+        '''
+        Return the bytes used by the image of path and its levels, 0 if not cached.
+        '''
+        entry = self.entries.get(self.key(path))
+        return self.entryBytes(entry) if entry is not None else 0
+
+    def insert(self, path, image, levels=None):
+        key = self.key(path)
+        if key is None or image.isNull():
+            return
+        if key in self.entries:
+            self.bytes -= self.entryBytes(self.entries.pop(key))
+        # The cached pixels are copied by the first QPainter on the image of the caller
+        entry = (QImage(image), levels)
+        if self.entryBytes(entry) > self.maxBytes:
+            return
+        self.entries[key] = entry
+        self.bytes += self.entryBytes(entry)
+        self.evict()
+
+    def setMaxBytes(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.maxBytes:
+            self.bytes -= self.entryBytes(self.entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        '''
+        Return the counters of the cache as a dict.
+        '''
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "count": len(self.entries), "bytes": self.bytes, "maxBytes": self.maxBytes}
+
+
+class DiskCache:
+    '''
+    On-disk cache of the reduced pyramid levels of images, keyed by path,
+    modification time and size. Each image is stored in one file holding a
+    JSON index followed by the levels split in JPEG (or PNG with alpha) tiles,
+    so one level is read without decoding the others. Files are written to a
+    temporary name then renamed, concurrent writers never expose partial
+    files. Reading touches the file, and the least recently used files are
+    pruned above maxBytes.
+    '''
+    magic = b"IVPYR1\n\0"
+
+    def __init__(self, directory=None, maxBytes=2 * 1024 * 1024 * 1024, tileSize=512, quality=85):
+        if directory is None:
+            # Not named after the application, so every tool using the viewer shares it
+            directory = os.path.join(QStandardPaths.writableLocation(
+                QStandardPaths.GenericCacheLocation), "ImageViewer")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.tileSize = tileSize
+        self.quality = quality
+
+    def filename(self, path):
+        key = ImageCache.key(path)
+        if key is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + ".pyr")
+
+    def contains(self, path):
+        filename = self.filename(path)
+        return filename is not None and os.path.exists(filename)
+
+    def store(self, path, size, levels):
+        '''
+        Store the reduced levels of the image of path, whose full size is size.
+        '''
+        filename = self.filename(path)
+        if filename is None or not levels:
+            return
+        index = {"width": size.width(), "height": size.height(), "levels": []}
+        chunks = []
+        offset = 0
+        for level in levels:
+            imageFormat = "PNG" if level.hasAlphaChannel() else "JPG"
+            tiles = []
+            for row in range(math.ceil(level.height() / self.tileSize)):
+                for column in range(math.ceil(level.width() / self.tileSize)):
+                    data = QByteArray()
+                    buffer = QBuffer(data)
+                    buffer.open(QIODevice.WriteOnly)
+                    level.copy(QRect(column * self.tileSize, row * self.tileSize, self.tileSize,
+                                     self.tileSize).intersected(level.rect())).save(buffer, imageFormat, self.quality)
+                    buffer.close()
+                    chunk = data.data()
+                    tiles.append([column, row, offset, len(chunk)])
+                    chunks.append(chunk)
+                    offset += len(chunk)
+            index["levels"].append({"width": level.width(), "height": level.height(),
+                                    "tileSize": self.tileSize, "tiles": tiles})
+        header = json.dumps(index).encode()
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(self.magic + struct.pack(">I", len(header)) + header)
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(temporary, filename)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        self.prune()
+
+    def readIndex(self, file):
+        if file.read(len(self.magic)) != self.magic:
+            return None
+        length, = struct.unpack(">I", file.read(4))
+        return json.loads(file.read(length).decode()), len(self.magic) + 4 + length
+
+    def load(self, path, maximumSize=None):
+        '''
+        Return the full size of the image of path and its cached reduced levels,
+        finest first, or (None, []) if not cached. With maximumSize, only the
+        finest level fitting in it is read.
+        '''
+        filename = self.filename(path)
+        try:
+            with open(filename, "rb") as file:
+                index, start = self.readIndex(file)
+                levels = index["levels"]
+                if maximumSize is not None:
+                    fitting = [level for level in levels if level["width"] <= maximumSize.width()
+                               and level["height"] <= maximumSize.height()]
+                    levels = fitting[:1] or levels[-1:]
+                images = [self.readLevel(file, start, level) for level in levels]
+            os.utime(filename)
+        except (OSError, TypeError, ValueError, struct.error):
+            # Missing, pruned meanwhile or corrupted
+            return None, []
+        return QSize(index["width"], index["height"]), images
+
+    def readLevel(self, file, start, level):
+        image = QImage(level["width"], level["height"],
+                       QImage.Format_ARGB32_Premultiplied)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for column, row, offset, length in level["tiles"]:
+            file.seek(start + offset)
+            painter.drawImage(column * level["tileSize"], row * level["tileSize"],
+                              QImage.fromData(file.read(length)))
+        painter.end()
+        return image
+
+    def prune(self):
+        '''
+        Remove the least recently used files until the cache fits in maxBytes.
+        Only the stored files count, the temporary files of other writers are left alone.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pyr"):
+                continue
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+class _StoreTask(QRunnable):
+    '''
+    Store the pyramid levels of an image in a DiskCache from a worker thread,
+    computing them first if None.
+    '''
+
+    def __init__(self, cache, path, image, levels=None, tileSize=512):
+        super().__init__()
+        self.cache = cache
+        self.path = path
+        self.image = image
+        self.levels = levels
+        self.tileSize = tileSize
+
+    def run(self):
+        levels = self.levels if self.levels is not None else pyramidLevels(self.image, self.tileSize)
+        self.cache.store(self.path, self.image.size(), levels)
+
+
+def prewarm(paths, cache, tileSize=512):
+    '''
+    Decode the images of paths and store their pyramids in cache, skipping the cached ones.
+    '''
+    for path in paths:
+        if not cache.contains(path):
+            image = QImage(path)
+            if not image.isNull():
+                cache.store(path, image.size(), pyramidLevels(image, tileSize))
+
+
+class Prefetcher(QObject):
+    '''
+    Decode the images around the current one of a sequence into an ImageCache.
+    Work that falls out of the window when the current image changes is cancelled.
+    '''
+    loaded = Signal(str, QImage, list)
+    failed = Signal(str, str)
+
+    def __init__(self, cache, parent=None, window=4, workers=2, tileSize=512):
+        super().__init__(parent)
+        self.cache = cache
+        self.window = window
+        self.tileSize = tileSize
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(workers)
+        self.generation = 0
+        self.tasks = {}
+        self.running = {}
+        self.sequence = []
+        self.index = 0
+        self.imageBytes = 0
+        self.diskCache = None
+
+    def setWindow(self, window):
+        '''
+        Set the number of images decoded ahead of and behind the current one.
+        '''
+        self.window = window
+
+    def setWorkerCount(self, workers):
+        self.threadPool.setMaxThreadCount(workers)
+
+    def isPending(self, path):
+        return path in self.tasks
+
+    def prefetch(self, sequence, index):
+        '''
+        Decode sequence[index] first then its neighbours, nearest and next images
+        first. Only the images fitting in the cache with the current one are
+        queued, far neighbours would otherwise evict the near ones.
+        '''
+        self.sequence = sequence
+        self.index = index
+        paths = [sequence[index]]
+        for distance in range(1, self.window + 1):
+            paths += [sequence[i] for i in (index + distance, index - distance)
+                      if 0 <= i < len(sequence)]
+        imageBytes = self.cache.entrySize(sequence[index]) or self.imageBytes
+        if imageBytes:
+            paths = paths[:max(self.cache.maxBytes // imageBytes, 1)]
+        for path in list(self.tasks):
+            if path not in paths:
+                self.cancel(path)
+        # Cached images of the window are touched farthest first, the LRU then evicts the others
+        for priority, path in enumerate(reversed(paths)):
+            if path in self.tasks or self.cache.touch(path):
+                continue
+            self.generation += 1
+            task = _LoadTask(self.generation, path, 0, tileSize=self.tileSize, diskCache=self.diskCache)
+            task.signals.loaded.connect(self.onLoaded)
+            task.signals.failed.connect(self.onFailed)
+            task.signals.finished.connect(self.onFinished)
+            self.tasks[path] = task
+            self.running[self.generation] = task
+            self.threadPool.start(task, priority)
+
+    def cancel(self, path=None):
+        '''
+        Cancel the decoding of path, or of everything if path is None.
+        '''
+        for path in [path] if path else list(self.tasks):
+            task = self.tasks.pop(path, None)
+            if task:
+                task.cancel()
+                if self.threadPool.tryTake(task):
+                    del self.running[task.generation]
+
+    @Slot(int, QImage, list)
+    def onLoaded(self, generation, image, levels):
+        task = self.running.get(generation)
+        if task and self.tasks.get(task.path) is task:
+            del self.tasks[task.path]
+            self.cache.insert(task.path, image, levels)
+            self.loaded.emit(task.path, image, levels)
+            known = self.imageBytes
+            self.imageBytes = self.cache.entryBytes((image, levels))
+            if not known and self.sequence:
+                # The first image gives the size of the others, drop what does not fit
+                self.prefetch(self.sequence, self.index)
+
+    @Slot(int, str)
+    def onFailed(self, generation, error):
+        task = self.running.get(generation)
+        if task and self.tasks.get(task.path) is task:
+            del self.tasks[task.path]
+            self.failed.emit(task.path, error)
+
+    @Slot(int)
+    def onFinished(self, generation):
+        task = self.running.pop(generation, None)
+        if task and self.tasks.get(task.path) is task:
+            del self.tasks[task.path]
+
+
+class _ThumbnailTask(QRunnable):
+    '''
+    Decode a thumbnail in a worker thread, from the disk cache when available.
+    '''
+
+    def __init__(self, generation, index, path, size, diskCache=None):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.generation = generation
+        self.index = index
+        self.path = path
+        self.size = size
+        self.diskCache = diskCache
+        self.signals = _LoadSignals()
+
+    def run(self):
+        try:
+            image = QImage()
+            if self.diskCache:
+                size, levels = self.diskCache.load(
+                    self.path, QSize(self.size, self.size))
+                if levels:
+                    image = levels[0]
+            if image.isNull():
+                reader = QImageReader(self.path)
+                if reader.size().isValid():
+                    reader.setScaledSize(reader.size().scaled(
+                        self.size, self.size, Qt.KeepAspectRatio))
+                image = reader.read()
+            if not image.isNull():
+                if max(image.width(), image.height()) > self.size:
+                    image = image.scaled(self.size, self.size, Qt.KeepAspectRatio,
+                                         Qt.SmoothTransformation)
+                self.signals.loaded.emit(self.generation, image, [])
+        finally:
+            self.signals.finished.emit(self.generation)
+
+
+class ThumbnailGrid(QObject):
+    '''
+    Contact sheet of images in its own scene. Only the cells intersecting the
+    viewport have items, the thumbnails are decoded by a thread pool, visible
+    rows first, and kept in a bounded LRU so memory stays flat.
+    '''
+
+    def __init__(self, view, thumbnailSize=192, spacing=8, maxThumbnails=1000, workers=4):
+        super().__init__(view)
+        self.view = view
+        self.scene = QGraphicsScene(self)
+        self.scene.setBackgroundBrush(QColor(32, 32, 32))
+        self.thumbnailSize = thumbnailSize
+        self.spacing = spacing
+        self.maxThumbnails = maxThumbnails
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(workers)
+        self.diskCache = None
+        self.paths = []
+        self.columns = 1
+        self.cells = {}
+        self.thumbnails = OrderedDict()
+        self.generation = 0
+        self.tasks = {}
+        self.running = {}
+
+    def setPaths(self, paths):
+        self.cancel()
+        self.scene.clear()
+        self.cells = {}
+        self.thumbnails.clear()
+        self.paths = list(paths)
+        self.layout()
+
+    def cellSize(self):
+        return self.thumbnailSize + self.spacing
+
+    def layout(self):
+        '''
+        Compute the columns from the viewport width and update the visible cells.
+        '''
+        columns = max(self.view.viewport().width() // self.cellSize(), 1)
+        if columns != self.columns:
+            self.columns = columns
+            for index, cell in self.cells.items():
+                cell.setPos(self.cellPosition(index))
+        rows = math.ceil(len(self.paths) / self.columns)
+        self.scene.setSceneRect(0, 0, self.columns * self.cellSize(),
+                                max(rows * self.cellSize(), 1))
+        self.updateVisible()
+
+    def cellPosition(self, index):
+        return QPoint(index % self.columns * self.cellSize(), index // self.columns * self.cellSize())
+
+    def cellAt(self, position):
+        '''
+        Return the index of the image at a scene position, -1 if none.
+        '''
+        column, row = int(position.x() // self.cellSize()), int(position.y() // self.cellSize())
+        index = row * self.columns + column
+        if position.x() < 0 or position.y() < 0 or column >= self.columns or index >= len(self.paths):
+            return -1
+        return index
+
+    def updateVisible(self):
+        '''
+        Create the cells intersecting the viewport, drop the others and
+        queue the missing thumbnails, the top rows first.
+        '''
+        if not self.view.gridMode or not self.paths:
+            return
+        rect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        firstRow = max(int(rect.top() // self.cellSize()) - 1, 0)
+        lastRow = int(rect.bottom() // self.cellSize()) + 1
+        visible = range(firstRow * self.columns,
+                        min((lastRow + 1) * self.columns, len(self.paths)))
+        for index in [index for index in self.cells if index not in visible]:
+            self.scene.removeItem(self.cells.pop(index))
+        for index in [index for index in self.tasks if index not in visible]:
+            self.cancelTask(self.tasks.pop(index))
+        for order, index in enumerate(visible):
+            if index not in self.cells:
+                cell = QGraphicsRectItem(0, 0, self.thumbnailSize, self.thumbnailSize)
+                cell.setBrush(QColor(48, 48, 48))
+                cell.setPen(QPen(Qt.NoPen))
+                cell.setPos(self.cellPosition(index))
+                self.scene.addItem(cell)
+                self.cells[index] = cell
+                pixmap = self.thumbnails.get(self.paths[index])
+                if pixmap is not None:
+                    self.thumbnails.move_to_end(self.paths[index])
+                    self.setThumbnail(cell, pixmap)
+                    continue
+            if not self.cells[index].childItems() and index not in self.tasks:
+                self.generation += 1
+                task = _ThumbnailTask(self.generation, index, self.paths[index],
+                                      self.thumbnailSize, self.diskCache)
+                task.signals.loaded.connect(self.onLoaded)
+                task.signals.finished.connect(self.onFinished)
+                self.tasks[index] = task
+                self.running[self.generation] = task
+                self.threadPool.start(task, len(visible) - order)
+
+    def setThumbnail(self, cell, pixmap):
+        item = QGraphicsPixmapItem(pixmap, cell)
+        item.setPos((self.thumbnailSize - pixmap.width()) / 2,
+                    (self.thumbnailSize - pixmap.height()) / 2)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            self.cancelTask(task)
+        self.tasks = {}
+
+    def cancelTask(self, task):
+        # A task already running still delivers, its path tells if it is current
+        if self.threadPool.tryTake(task):
+            del self.running[task.generation]
+
+    @Slot(int, QImage, list)
+    def onLoaded(self, generation, image, levels):
+        task = self.running.get(generation)
+        if task is None or task.index >= len(self.paths) or self.paths[task.index] != task.path:
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.thumbnails[task.path] = pixmap
+        if len(self.thumbnails) > self.maxThumbnails:
+            self.thumbnails.popitem(last=False)
+        cell = self.cells.get(task.index)
+        if cell is not None and not cell.childItems():
+            self.setThumbnail(cell, pixmap)
+
+    @Slot(int)
+    def onFinished(self, generation):
+        task = self.running.pop(generation, None)
+        if task and self.tasks.get(task.index) is task:
+            del self.tasks[task.index]
+
+
+class _ExportSignals(QObject):
+    progress = Signal(int, int, int)
+    saved = Signal(int, str)
+    failed = Signal(int, str, str)
+    finished = Signal(int)
+
+
+class _ExportTask(QRunnable):
+    '''
+    Encode images in a worker thread. Each job is a list of (source, output)
+    where source is a QImage or the path of an image to convert. Files are
+    written under a temporary name then renamed, so an output is never partial.
+    '''
+
+    def __init__(self, job, items, imageFormat=None, quality=-1):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.job = job
+        self.items = items
+        self.format = imageFormat
+        self.quality = quality
+        self.cancelled = False
+        self.signals = _ExportSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            for done, (source, output) in enumerate(self.items):
+                if self.cancelled:
+                    return
+                if isinstance(source, QImage):
+                    image = source
+                    error = "" if not image.isNull() else "No image to write"
+                else:
+                    image = QImageReader(source).read()
+                    error = "" if not image.isNull() else "Cannot read " + source
+                error = error or self.write(image, output)
+                if error:
+                    self.signals.failed.emit(self.job, output, error)
+                else:
+                    self.signals.saved.emit(self.job, output)
+                self.signals.progress.emit(self.job, done + 1, len(self.items))
+        finally:
+            self.signals.finished.emit(self.job)
+
+    def write(self, image, output):
+        imageFormat = self.format or os.path.splitext(output)[1][1:].lower()
+        descriptor, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(output)), suffix=".part")
+        os.close(descriptor)
+        writer = QImageWriter(temporary, imageFormat.encode())
+        writer.setQuality(self.quality)
+        if not writer.write(image):
+            error = writer.errorString()
+            os.remove(temporary)
+            return error
+        try:
+            os.replace(temporary, output)
+        except OSError as error:
+            os.remove(temporary)
+            return str(error)
+        return ""
+
+
+class ImageExporter(QObject):
+    '''
+    Save images from a thread pool without blocking the GUI thread. Every call
+    returns a job number used by the signals: progress sends the number of
+    images done and their total, saved and failed each written file.
+    '''
+    progress = Signal(int, int, int)
+    saved = Signal(int, str)
+    failed = Signal(int, str, str)
+    finished = Signal(int)
+
+    def __init__(self, parent=None, workers=2):
+        super().__init__(parent)
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(workers)
+        self.job = 0
+        self.tasks = {}
+
+    def save(self, image, path, imageFormat=None, quality=-1):
+        '''
+        Encode image to path, the format is guessed from the suffix if None.
+        The image must not be painted anymore by the caller, pass a copy otherwise.
+        '''
+        return self.start([(image, path)], imageFormat, quality)
+
+    def exportFiles(self, paths, directory, imageFormat="png", quality=-1, images=None):
+        '''
+        Convert the files of paths to directory in another format. images can
+        map some paths to the QImage to write instead of the file content.
+        '''
+        images = images or {}
+        items = [(images.get(path, path), os.path.join(
+            directory, os.path.splitext(os.path.basename(path))[0] + "." + imageFormat))
+            for path in paths]
+        return self.start(items, imageFormat, quality)
+
+    def start(self, items, imageFormat, quality):
+        self.job += 1
+        task = _ExportTask(self.job, items, imageFormat, quality)
+        task.signals.progress.connect(self.progress)
+        task.signals.saved.connect(self.saved)
+        task.signals.failed.connect(self.failed)
+        task.signals.finished.connect(self.onFinished)
+        self.tasks[self.job] = task
+        self.threadPool.start(task)
+        return self.job
+
+    def cancel(self, job=None):
+        '''
+        Stop a job, or every job if None, before its next image.
+        '''
+        for job in [job] if job else list(self.tasks):
+            task = self.tasks.get(job)
+            if task:
+                task.cancel()
+                if self.threadPool.tryTake(task):
+                    del self.tasks[job]
+                    self.finished.emit(job)
+
+    def isBusy(self):
+        return bool(self.tasks)
+
+    @Slot(int)
+    def onFinished(self, job):
+        self.tasks.pop(job, None)
+        self.finished.emit(job)
+
+
+def imageSequence(source):
+    '''
+    Return the sorted image paths of a directory, of a glob pattern or of a list of paths.
+    '''
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            extensions = {"." + imageFormat.data().decode().lower()
+                          for imageFormat in QImageReader.supportedImageFormats()}
+            return sorted(os.path.join(source, name) for name in os.listdir(source)
+                          if os.path.splitext(name)[1].lower() in extensions)
+        return sorted(glob.glob(source))
+    return list(source)
+
+
+def arrayToImage(array, levels=None):
+    '''
+    Wrap a NumPy array, possibly memory-mapped, in a QImage. 8-bit gray, RGB and
+    RGBA arrays with contiguous rows are wrapped without copy, the array must
+    then be kept alive as long as the image. Other arrays are mapped to 8-bit
+    gray with levels (low, high), the minimum and maximum by default.
+    Return the image and the array owning its memory.
+    '''
+    if numpy is None:
+        raise ImportError("NumPy is required to display arrays")
+    formats = {1: QImage.Format_Grayscale8, 3: QImage.Format_RGB888, 4: QImage.Format_RGBA8888}
+    channels = array.shape[2] if array.ndim == 3 else 1
+    if array.ndim not in (2, 3) or channels not in formats:
+        raise ValueError("Unsupported array shape {}".format(array.shape))
+    if array.dtype != numpy.uint8 or levels is not None:
+        if channels != 1:
+            raise ValueError("Only gray arrays can be windowed")
+        low, high = levels if levels is not None else (array.min(), array.max())
+        scale = 255 / max(float(high) - float(low), 1e-12)
+        windowed = numpy.empty(array.shape, numpy.uint8)
+        # Convert by blocks of rows to bound the temporary float memory
+        for row in range(0, array.shape[0], 1024):
+            block = array[row:row + 1024].astype(numpy.float32)
+            windowed[row:row + 1024] = numpy.clip((block - low) * scale, 0, 255)
+        array = windowed
+    if array.strides[-1] != 1 or (array.ndim == 3 and array.strides[1] != channels):
+        array = numpy.ascontiguousarray(array)
+    image = QImage(array, array.shape[1], array.shape[0],
+                   array.strides[0], formats[channels])
+    return image, array
+
+
+def loadArray(path, shape=None, dtype=None, offset=0):
+    '''
+    Memory-map a .npy file, or a raw file given its shape and dtype.
+    '''
+    if numpy is None:
+        raise ImportError("NumPy is required to display arrays")
+    if shape is None:
+        return numpy.load(path, mmap_mode="r")
+    return numpy.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+class ViewerGroup(QObject):
+    '''
+    Link the zoom and the position of several viewers, and share their decoded
+    images. Changes of one viewer are propagated to the others at most once per
+    display frame, whatever the rate of input events. Viewers showing images
+    of different sizes are matched on the image extent.
+    '''
+
+    def __init__(self, parent=None, cacheBytes=1024 * 1024 * 1024):
+        super().__init__(parent)
+        self.viewers = []
+        self.imageCache = ImageCache(cacheBytes)
+        self.source = None
+        self.synchronizing = False
+        self.waiting = {}
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(frameInterval())
+        self.timer.timeout.connect(self.synchronize)
+
+    def addViewer(self, viewer):
+        '''
+        Link a viewer, which then uses the image cache of the group.
+        '''
+        if viewer in self.viewers:
+            return
+        self.viewers.append(viewer)
+        viewer.imageCache = self.imageCache
+        viewer.prefetcher.cache = self.imageCache
+        viewer.zoomController.zoomChanged.connect(self.onViewChanged)
+        viewer.zoomController.animating.connect(self.onAnimating)
+        viewer.horizontalScrollBar().valueChanged.connect(self.onViewChanged)
+        viewer.verticalScrollBar().valueChanged.connect(self.onViewChanged)
+        viewer.loader.loaded.connect(self.shareImage)
+        viewer.loader.reducedLoaded.connect(self.shareReduced)
+
+    def removeViewer(self, viewer):
+        if viewer not in self.viewers:
+            return
+        self.viewers.remove(viewer)
+        viewer.imageCache = ImageCache()
+        viewer.prefetcher.cache = viewer.imageCache
+        viewer.zoomController.zoomChanged.disconnect(self.onViewChanged)
+        viewer.zoomController.animating.disconnect(self.onAnimating)
+        viewer.horizontalScrollBar().valueChanged.disconnect(self.onViewChanged)
+        viewer.verticalScrollBar().valueChanged.disconnect(self.onViewChanged)
+        viewer.loader.loaded.disconnect(self.shareImage)
+        viewer.loader.reducedLoaded.disconnect(self.shareReduced)
+        for waiting in self.waiting.values():
+            if viewer in waiting:
+                waiting.remove(viewer)
+        if self.source is viewer:
+            self.source = None
+
+    def loadImages(self, paths):
+        '''
+        Open one path per viewer, in order. A file opened by several viewers is
+        decoded once.
+        '''
+        self.waiting = {}
+        for viewer, path in zip(self.viewers, paths):
+            if path in self.waiting:
+                viewer.loader.cancel()
+                viewer.clear()
+                self.waiting[path].append(viewer)
+                continue
+            viewer.loadImage(path)
+            if viewer.loader.isLoading():
+                self.waiting[path] = []
+
+    @Slot(str, QImage, list)
+    def shareImage(self, path, image, levels):
+        for viewer in self.waiting.pop(path, []):
+            viewer.displayImage(path, image, levels)
+        self.synchronizeFrom(self.viewers[0] if self.viewers else None)
+
+    @Slot(str, QImage, QSize)
+    def shareReduced(self, path, image, size):
+        for viewer in self.waiting.pop(path, []):
+            viewer.displayReduced(path, image, size)
+        self.synchronizeFrom(self.viewers[0] if self.viewers else None)
+
+    def onViewChanged(self):
+        if self.synchronizing:
+            return
+        viewer = self.sender()
+        while viewer is not None and viewer not in self.viewers:
+            viewer = viewer.parent()
+        if viewer is not None:
+            self.source = viewer
+            if not self.timer.isActive():
+                self.timer.start()
+
+    @Slot(bool)
+    def onAnimating(self, animating):
+        if self.synchronizing:
+            return
+        for viewer in self.viewers:
+            viewer.renderPolicy.setAnimating(animating)
+
+    def synchronizeFrom(self, viewer):
+        if viewer is not None:
+            self.source = viewer
+            self.synchronize()
+
+    def synchronize(self):
+        '''
+        Apply the zoom and the center of the last changed viewer to the others,
+        with a single repaint each.
+        '''
+        source = self.source
+        if source is None or source.sceneRect().isEmpty():
+            return
+        rect = source.sceneRect()
+        center = source.mapToScene(source.viewport().rect().center()) - rect.topLeft()
+        relative = QPointF(center.x() / rect.width(), center.y() / rect.height())
+        self.synchronizing = True
+        for viewer in self.viewers:
+            target = viewer.sceneRect()
+            if viewer is source or target.isEmpty():
+                continue
+            viewer.setUpdatesEnabled(False)
+            controller = viewer.zoomController
+            controller.timer.stop()
+            controller.target = source.zoomController.zoom * rect.width() / target.width()
+            controller.apply(controller.target)
+            viewer.centerOn(target.topLeft() + QPointF(
+                relative.x() * target.width(), relative.y() * target.height()))
+            viewer.renderPolicy.interact()
+            viewer.setUpdatesEnabled(True)
+        self.synchronizing = False
+
 
 class ImageViewer(QGraphicsView):
+    imageChanged = Signal()
 
     def __init__(self):
         super().__init__()
@@ -42,86 +2684,710 @@ class ImageViewer(QGraphicsView):
         self.undoAction.setShortcut(QKeySequence(QKeySequence.Undo))
         self.undoAction.triggered.connect(self.undo)
         self.addAction(self.undoAction)
-        self.painterStack = []
+        self.redoAction = QAction(self.tr("Redo"), self)
+        self.redoAction.setShortcut(QKeySequence(QKeySequence.Redo))
+        self.redoAction.triggered.connect(self.redo)
+        self.addAction(self.redoAction)
+
+        self.nextAction = QAction(self.tr("Next image"), self)
+        self.nextAction.setShortcut(QKeySequence(QKeySequence.MoveToNextPage))
+        self.nextAction.triggered.connect(self.nextImage)
+        self.addAction(self.nextAction)
+        self.previousAction = QAction(self.tr("Previous image"), self)
+        self.previousAction.setShortcut(
+            QKeySequence(QKeySequence.MoveToPreviousPage))
+        self.previousAction.triggered.connect(self.previousImage)
+        self.addAction(self.previousAction)
+        self.sequence = []
+        self.sequenceIndex = -1
 
         self.scene = QGraphicsScene(self)
-        self.image = QGraphicsPixmapItem()
+        self.image = TiledImageItem()
         self.image.setAcceptDrops(True)
         self.scene.addItem(self.image)
+        self.undoHistory = UndoHistory(self.image, parent=self)
+        self.preview = QGraphicsPixmapItem()
+        self.preview.setTransformationMode(Qt.SmoothTransformation)
+        self.preview.setZValue(-1)
+        self.scene.addItem(self.preview)
+        self.detail = QGraphicsPixmapItem()
+        self.detail.setTransformationMode(Qt.SmoothTransformation)
+        self.detail.setZValue(0.5)
+        self.scene.addItem(self.detail)
+        self.imagePath = ""
+        self.decodedScale = 1
+        self.decodeAtDisplayResolution = False
+        # Strokes drawn over a reduced image until the full one is decoded
+        self.fullResolutionPending = False
+        self.heldStrokes = []
+        # Split compare: a second image clipped to the right of splitPosition
+        self.compareClip = QGraphicsRectItem()
+        self.compareClip.setPen(QPen(Qt.NoPen))
+        self.compareClip.setFlag(QGraphicsItem.ItemClipsChildrenToShape)
+        self.compareClip.setZValue(0.6)
+        self.compareClip.setVisible(False)
+        self.scene.addItem(self.compareClip)
+        self.compare = TiledImageItem(parent=self.compareClip)
+        self.splitPosition = 0.5
+        self.strokeLayer = StrokeLayer()
+        self.strokeLayer.setZValue(1)
+        self.scene.addItem(self.strokeLayer)
+        self.annotations = AnnotationLayer()
+        self.annotations.setZValue(0.9)
+        self.scene.addItem(self.annotations)
+        self.annotationMode = False
         self.setScene(self.scene)
+        self.grid = ThumbnailGrid(self)
+        self.gridMode = False
+        self.singleTransform = self.transform()
+        self.horizontalScrollBar().valueChanged.connect(self.grid.updateVisible)
+        self.verticalScrollBar().valueChanged.connect(self.grid.updateVisible)
         self.setTransformationAnchor(QGraphicsView.AnchorViewCenter)
         self.setDragMode(QGraphicsView.NoDrag)
 
         self.currentZoom = 1
+        self.scrollBatch = None
+        self.navigation = NavigationController(self)
+        self.zoomController = ZoomController(self)
+        self.zoomController.zoomChanged.connect(self.setCurrentZoom)
+        self.renderPolicy = RenderPolicy(self)
+        self.zoomController.animating.connect(self.renderPolicy.setAnimating)
+        self.fitAction = QAction(self.tr("Zoom to fit"), self)
+        self.fitAction.setShortcut(QKeySequence("Ctrl+0"))
+        self.fitAction.triggered.connect(lambda: self.navigation.fitInView(self.sceneRect()))
+        self.addAction(self.fitAction)
+        self.actualSizeAction = QAction(self.tr("Actual size"), self)
+        self.actualSizeAction.setShortcut(QKeySequence("Ctrl+1"))
+        self.actualSizeAction.triggered.connect(
+            self.zoomController.zoomActualSize)
+        self.addAction(self.actualSizeAction)
 
         self.isDrawable = True
         self.brushPixmap = QPixmap(":/assets/cursor.png")
+        self.brushCursors = BrushCursorCache(self.brushPixmap)
+        self.brushOutline = None
+
+        self.stats = None
+        self.statsHud = False
         self.setBrush()
 
         self.painter = QPainter()
 
+        # Mouse moves are collected and drawn by batches
+        self.strokePoints = []
+        self.strokeRecord = []
+        self.strokeId = 0
+        self.strokeSmoothing = False
+        self.strokeFlushCount = 0
+        self.strokeTimer = QTimer(self)
+        self.strokeTimer.setSingleShot(True)
+        self.strokeTimer.timeout.connect(self.flushStroke)
+        self.setMaxStrokeFlushRate(60)
+
+        self.imageCache = ImageCache()
+        self.diskCache = None
+        self.loader = ImageLoader(self)
+        self.loader.previewLoaded.connect(self.displayPreview)
+        self.loader.loaded.connect(self.displayImage)
+        self.loader.stripeLoaded.connect(self.displayStripe)
+        self.loader.progressiveLoaded.connect(self.finishStripes)
+        self.loader.reducedLoaded.connect(self.displayReduced)
+        self.loader.regionLoaded.connect(self.displayDetail)
+        self.loader.levelsLoaded.connect(self.displayLevels)
+        self.detailTimer = QTimer(self)
+        self.detailTimer.setSingleShot(True)
+        self.detailTimer.setInterval(150)
+        self.detailTimer.timeout.connect(self.loadDetail)
+        self.zoomController.zoomChanged.connect(self.scheduleDetail)
+        self.horizontalScrollBar().valueChanged.connect(self.scheduleDetail)
+        self.verticalScrollBar().valueChanged.connect(self.scheduleDetail)
+        self.prefetcher = Prefetcher(self.imageCache, self)
+        self.prefetcher.loaded.connect(self.displayPrefetched)
+        self.exporter = ImageExporter(self)
+        self.minimap = None
+
     def setBrush(self, color=Qt.white, size=25, factor=1):
         '''
         Set the brush color and size. The cursor is scalled with the current zoom.
         '''
         self.brushColor = color
         self.brushSize = size
-        self.drawingCursor = QCursor(
-            self.brushPixmap.scaledToHeight(self.brushSize*factor))
+        self.drawingCursor = self.brushCursors.cursor(self.brushSize*factor)
+        self.drawBrushOutline = self.drawingCursor is None
+        if self.drawBrushOutline:
+            self.drawingCursor = QCursor(Qt.CrossCursor)
+
+    def setBrushOutline(self, position):
+        '''
+        Move the brush outline drawn when the brush is too large for a cursor, None to hide it.
+        '''
+        for center in (self.brushOutline, position):
+            if center is not None:
+                margin = self.brushSize / 2 + 2 / self.currentZoom
+                self.updateScene([QRectF(center, center).adjusted(-margin, -margin, margin, margin)])
+        self.brushOutline = position if self.drawBrushOutline else None
+
+    def drawForeground(self, painter, rect):
+        if self.compareClip.isVisible():
+            split = self.compareClip.rect()
+            painter.setPen(QPen(Qt.white, 0))
+            painter.drawLine(split.topLeft(), split.bottomLeft())
+        if self.brushOutline is not None:
+            painter.setPen(QPen(self.brushColor, 0))
+            painter.drawEllipse(self.brushOutline,
+                                self.brushSize / 2, self.brushSize / 2)
+        if self.statsHud and self.stats:
+            lines = self.stats.lines()
+            if lines:
+                painter.save()
+                painter.resetTransform()
+                painter.setFont(QFont("monospace", 9))
+                height = painter.fontMetrics().height()
+                painter.fillRect(QRect(4, 4, 300, height * len(lines) + 8),
+                                 QColor(0, 0, 0, 160))
+                painter.setPen(Qt.white)
+                for index, line in enumerate(lines):
+                    painter.drawText(QPoint(
+                        10, 8 + painter.fontMetrics().ascent() + index * height), line)
+                painter.restore()
+
+    def setStatsEnabled(self, enabled, hud=False):
+        '''
+        Record frame and input latency statistics in self.stats, whose updated
+        signal sends them every second. With hud, they are also drawn on the view,
+        which then repaints the whole viewport on every update.
+        '''
+        if self.stats:
+            self.stats.timer.stop()
+            self.stats.deleteLater()
+            self.stats = None
+        if self.statsHud:
+            self.setViewportUpdateMode(self.hudUpdateMode)
+        self.statsHud = enabled and hud
+        if enabled:
+            self.stats = ViewerStats(self)
+        if self.statsHud:
+            self.hudUpdateMode = self.viewportUpdateMode()
+            # The HUD is fixed on the viewport, partial updates would smear it
+            self.setViewportUpdateMode(QGraphicsView.FullViewportUpdate)
+            self.stats.updated.connect(self.viewport().update)
+        self.viewport().update()
+
+    def statistics(self):
+        '''
+        Return the last statistics snapshot, empty if disabled.
+        '''
+        return dict(self.stats.current) if self.stats else {}
+
+    def paintEvent(self, event):
+        if not self.stats:
+            super().paintEvent(event)
+            return
+        start = time.perf_counter()
+        super().paintEvent(event)
+        self.stats.framePainted(start, time.perf_counter())
 
     def setImage(self, path):
         '''
         Open an image from a file.
         '''
+        self.loader.cancel()
+        image = self.imageCache.get(path)
+        if image is None:
+            self.displayImage(path, QImage(path))
+        else:
+            self.displayImage(path, image, self.imageCache.levels(path))
+
+    def loadImage(self, path):
+        '''
+        Open an image from a file without blocking the GUI thread. A low
+        resolution preview is displayed first when the format allows it.
+        Progress and errors are reported by the signals of self.loader.
+        '''
+        image = self.imageCache.get(path)
+        if image is not None:
+            self.loader.cancel()
+            self.displayImage(path, image, self.imageCache.levels(path))
+            return
         self.clear()
-        self.image.setPixmap(QPixmap(path))
+        if self.diskCache:
+            size, levels = self.diskCache.load(path, self.viewport().size())
+            if levels:
+                self.displayPreview(path, levels[0], size)
+        if self.decodeAtDisplayResolution:
+            self.loader.load(path, self.viewport().size() *
+                             self.viewport().devicePixelRatioF())
+        else:
+            self.loader.load(path)
 
-    def wheelEvent(self, event):
+    def setDiskCache(self, cache):
+        '''
+        Use a DiskCache, or None, to store the pyramid levels of the opened
+        images and show them at once when the images are opened again.
+        '''
+        self.diskCache = cache
+        self.loader.diskCache = cache
+        self.prefetcher.diskCache = cache
+        self.grid.diskCache = cache
+
+    def setCompareImage(self, path):
+        '''
+        Show another image, scaled to the current one, on the right of a split
+        line moved with Shift + left drag or setSplitPosition. None to stop comparing.
+        '''
+        if not path:
+            self.compare.setImage(QImage())
+            self.compareClip.setVisible(False)
+            self.viewport().update()
+            return
+        image = self.imageCache.get(path)
+        if image is None:
+            image = QImage(path)
+            self.imageCache.insert(path, image, self.compare.setImage(image))
+        else:
+            self.compare.setImage(image, levels=self.imageCache.levels(path))
+        self.compareClip.setVisible(not image.isNull())
+        self.updateSplit()
+
+    def setSplitPosition(self, position):
+        '''
+        Set the split line of the compare mode, from 0 (left) to 1 (right) of the image.
         '''
-        Zoom with wheel.
+        self.splitPosition = min(max(position, 0), 1)
+        self.updateSplit()
+
+    def updateSplit(self):
+        rect = self.sceneRect()
+        compareSize = self.compare.boundingRect().size()
+        if compareSize.width() > 0:
+            self.compare.setScale(rect.width() / compareSize.width())
+            self.compare.setZoom(self.currentZoom)
+        self.updateScene([self.compareClip.sceneBoundingRect()])
+        self.compareClip.setRect(QRectF(rect.left() + rect.width() * self.splitPosition, rect.top(),
+                                        rect.width() * (1 - self.splitPosition), rect.height()))
+        self.updateScene([self.compareClip.sceneBoundingRect()])
+
+    def showGrid(self, source=None):
+        '''
+        Show the images of a directory, a glob pattern or a list of paths as a
+        grid of thumbnails, the current sequence if source is None.
+        Double-clicking a thumbnail opens it.
+        '''
+        if source is not None or not self.grid.paths:
+            self.grid.setPaths(imageSequence(source) if source is not None else self.sequence)
+        if not self.gridMode:
+            self.singleTransform = self.transform()
+            self.gridMode = True
+            self.setScene(self.grid.scene)
+            self.resetTransform()
+            if self.minimap:
+                self.minimap.hide()
+        self.grid.layout()
+
+    def showSingle(self):
+        '''
+        Leave the grid and show the single image view again.
+        '''
+        if self.gridMode:
+            self.grid.cancel()
+            self.gridMode = False
+            self.setScene(self.scene)
+            self.setTransform(self.singleTransform)
+            if self.minimap:
+                self.minimap.show()
+
+    def mouseDoubleClickEvent(self, event):
+        if self.gridMode and event.button() == Qt.LeftButton:
+            index = self.grid.cellAt(self.mapToScene(event.pos()))
+            if index >= 0:
+                self.showSingle()
+                self.setSequence(self.grid.paths, index)
+            return
+        super().mouseDoubleClickEvent(event)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.gridMode:
+            self.grid.layout()
+        if self.minimap:
+            self.placeMinimap()
+
+    def setMinimapVisible(self, visible):
+        '''
+        Show a Minimap over the top right corner of the view.
+        '''
+        if visible and self.minimap is None:
+            self.minimap = Minimap(self, parent=self)
+            self.minimap.refresh()
+            self.placeMinimap()
+        if self.minimap:
+            self.minimap.setVisible(visible and not self.gridMode)
+
+    def placeMinimap(self):
+        viewport = self.viewport().geometry()
+        self.minimap.move(viewport.right() - self.minimap.width() - 8, viewport.top() + 8)
+
+    def setDecodeAtDisplayResolution(self, enabled):
+        '''
+        Decode the images opened by loadImage at the size needed to fit the
+        view, when the format allows it. Zooming in decodes the visible
+        region at a higher resolution, and drawing loads the full image.
+        '''
+        self.decodeAtDisplayResolution = enabled
+
+    @Slot(str, QImage, QSize)
+    def displayReduced(self, path, image, size):
+        # The reduced image is not cached, it would be returned for full resolution requests
+        self.resetImage(path)
+        self.decodedScale = image.width() / size.width()
+        self.image.setImage(image)
+        self.image.setScale(1 / self.decodedScale)
+        self.setImageSize(size)
+        self.zoomController.zoomToFit(animated=False)
+        self.image.setZoom(self.currentZoom)
+        self.imageChanged.emit()
+
+    def scheduleDetail(self):
+        if self.decodedScale < 1:
+            self.detailTimer.start()
+
+    def loadDetail(self):
+        '''
+        Decode the visible region at the resolution of the view if the decoded image is too coarse.
+        '''
+        scale = min(self.currentZoom * self.viewport().devicePixelRatioF(), 1)
+        if self.decodedScale >= 1 or scale <= self.decodedScale * 1.1:
+            self.detail.setPixmap(QPixmap())
+            return
+        rect = self.mapToScene(self.viewport().rect()).boundingRect().toAlignedRect().intersected(
+            self.sceneRect().toAlignedRect())
+        if not rect.isEmpty():
+            self.loader.loadRegion(self.imagePath, rect, scale)
+
+    @Slot(str, QRect, QImage)
+    def displayDetail(self, path, rect, image):
+        if path != self.imagePath or self.decodedScale >= 1:
+            return
+        self.detail.setPixmap(QPixmap.fromImage(image))
+        self.detail.setPos(rect.topLeft())
+        self.detail.setScale(rect.width() / image.width())
+
+    def ensureFullResolution(self, wait=False):
+        '''
+        Display the full image if only a reduced one is, keeping the view
+        transform. It is decoded by self.loader unless wait is True.
+        Return True if the full image is displayed.
         '''
-        if event.angleDelta().y() > 0:
-            factor = 1.25
-            self.currentZoom *= factor
-            self.setBrush(size=self.brushSize, factor=self.currentZoom)
+        if self.decodedScale >= 1:
+            return True
+        path = self.imagePath
+        image = self.imageCache.get(path)
+        if image is None and wait:
+            self.loader.cancel()
+            image = QImage(path)
+        if image is not None:
+            self.displayImage(path, image, self.imageCache.levels(path))
+            return True
+        if not (self.fullResolutionPending and self.loader.isLoading()):
+            self.fullResolutionPending = True
+            self.loader.load(path)
+        return False
+
+    def replayHeldStrokes(self):
+        '''
+        Draw again the strokes made over the reduced image, cleared with it,
+        merging the finished ones.
+        '''
+        self.fullResolutionPending = False
+        self.strokePoints = []
+        for record in self.heldStrokes:
+            self.strokeId += 1
+            self.strokeLayer.drawPath(record.path(), record.pen())
+            self.commitStroke()
+        self.heldStrokes = []
+        if len(self.strokeRecord) > 1:
+            # The stroke in progress goes on from its last point
+            self.strokeId += 1
+            record = StrokeRecord(self.strokeRecord, self.brushSize, self.brushColor, self.strokeSmoothing)
+            self.strokeLayer.drawPath(record.path(), record.pen())
+            self.drawReference = self.strokeRecord[-1]
+
+    def setSequence(self, source, index=0):
+        '''
+        Browse a directory, a glob pattern or a list of paths. The neighbours
+        of the current image are decoded in the background by self.prefetcher.
+        '''
+        self.sequence = imageSequence(source)
+        self.sequenceIndex = -1
+        if self.sequence:
+            self.setSequenceIndex(index)
+
+    def setSequenceIndex(self, index):
+        index = min(max(index, 0), len(self.sequence) - 1)
+        if index == self.sequenceIndex or not self.sequence:
+            return
+        self.sequenceIndex = index
+        path = self.sequence[index]
+        self.loader.cancel()
+        image = self.imageCache.get(path)
+        if image is not None:
+            self.displayImage(path, image, self.imageCache.levels(path))
         else:
-            factor = 0.8
-            self.currentZoom *= factor
-            self.setBrush(size=self.brushSize, factor=self.currentZoom)
-        self.scale(factor, factor)
+            # Displayed by displayPrefetched once decoded
+            self.clear()
+        self.prefetcher.prefetch(self.sequence, index)
+
+    def nextImage(self):
+        self.setSequenceIndex(self.sequenceIndex + 1)
+
+    def previousImage(self):
+        self.setSequenceIndex(self.sequenceIndex - 1)
+
+    @Slot(str, QImage, list)
+    def displayPrefetched(self, path, image, levels):
+        if 0 <= self.sequenceIndex < len(self.sequence) and path == self.sequence[self.sequenceIndex] \
+                and self.image.isNull():
+            self.displayImage(path, image, levels)
+
+    @Slot(str, QImage, QSize)
+    def displayPreview(self, path, preview, size):
+        self.preview.setPixmap(QPixmap.fromImage(preview))
+        self.preview.setScale(size.width() / preview.width())
+        self.scene.setSceneRect(QRectF(QPoint(), size))
+
+    def setArray(self, array, levels=None):
+        '''
+        Display a NumPy array, see arrayToImage. Arrays in 8 bits are drawn
+        from their memory at full resolution, and their reduced levels are
+        computed by self.loader from every other pixel. Memory-mapped files are
+        then only read where displayed, once the levels are known.
+        '''
+        self.loader.cancel()
+        image, data = arrayToImage(array, levels)
+        self.displayImage("", image, data=data)
+        self.loadPendingLevels()
+
+    def loadPendingLevels(self):
+        '''
+        Compute the reduced levels of a displayed array in self.loader, if still missing.
+        '''
+        if self.image.pendingLevels:
+            self.loader.loadLevels(self.image.sourceData)
+
+    @Slot(list)
+    def displayLevels(self, levels):
+        self.image.setLevels(levels)
+        self.image.setZoom(self.currentZoom)
+        self.imageChanged.emit()
+
+    @Slot(str, QRect, QImage, QSize)
+    def displayStripe(self, path, rect, stripe, size):
+        '''
+        Display a stripe of a progressive load, the preview remains visible below
+        the rows not decoded yet.
+        '''
+        if self.image.isNull() or path != self.imagePath:
+            self.resetImage(path, keepPreview=True)
+            blank = QImage(size, QImage.Format_ARGB32_Premultiplied)
+            blank.fill(Qt.transparent)
+            # Nothing to scale or copy before the first rows
+            self.image.setImage(blank, blank=True)
+            # Painting would otherwise copy the pixels shared with this handle
+            del blank
+            self.setImageSize(size)
+        self.painter.begin(self.image.image())
+        self.painter.setCompositionMode(QPainter.CompositionMode_Source)
+        self.painter.drawImage(rect.topLeft(), stripe)
+        self.painter.end()
+        self.image.updateRegion(rect)
+
+    @Slot(str)
+    def finishStripes(self, path):
+        self.preview.setPixmap(QPixmap())
+        image = self.image.image()
+        self.imageCache.insert(path, image)
+        if self.diskCache and not self.diskCache.contains(path):
+            # The worker reads its own handle, the next stroke copies the pixels
+            QThreadPool.globalInstance().start(_StoreTask(
+                self.diskCache, path, QImage(image), tileSize=self.image.tileSize))
+        self.imageChanged.emit()
+
+    @Slot(str, QImage, list)
+    def displayImage(self, path, image, levels=None, data=None):
+        '''
+        Display a decoded image. levels are its pyramid levels if already
+        known, data the object owning its memory if any.
+        '''
+        self.resetImage(path)
+        computed = levels is None
+        levels = self.image.setImage(image, data, levels)
+        self.imageCache.insert(path, image, levels)
+        # Levels from the loader are read from or stored in the disk cache by its thread
+        if self.diskCache and path and computed and levels and not self.diskCache.contains(path):
+            QThreadPool.globalInstance().start(_StoreTask(
+                self.diskCache, path, image, levels))
+        self.setImageSize(image.size())
+        if self.fullResolutionPending:
+            self.replayHeldStrokes()
+        self.imageChanged.emit()
+
+    def resetImage(self, path, keepPreview=False):
+        '''
+        Remove the displayed image before showing the one of path, and its
+        preview unless keepPreview.
+        '''
+        if path and path != self.imagePath:
+            # Annotations belong to the image they were drawn on
+            self.annotations.clear()
+        if path != self.imagePath:
+            self.fullResolutionPending = False
+            self.heldStrokes = []
+        if path != self.imagePath or not path or self.decodedScale >= 1:
+            # Kept when the full resolution replaces a reduced decode of the same file
+            self.undoHistory.clear()
+        preview = self.preview.pixmap()
+        self.removeImage()
+        if keepPreview:
+            self.preview.setPixmap(preview)
+        self.imagePath = path
+
+    def setImageSize(self, size):
+        '''
+        Fit the scene, the stroke layer and the compared image to an image of size.
+        '''
+        self.strokeLayer.setBounds(QRect(QPoint(), size))
+        self.image.setZoom(self.currentZoom)
+        self.scene.setSceneRect(QRectF(QPoint(), size))
+        if self.compareClip.isVisible():
+            self.updateSplit()
+
+    @Slot(float)
+    def setCurrentZoom(self, zoom):
+        self.currentZoom = zoom
+        self.setBrush(size=self.brushSize, factor=self.currentZoom)
+        self.image.setZoom(self.currentZoom)
+        if self.compareClip.isVisible():
+            self.compare.setZoom(self.currentZoom)
+
+    def setOpenGLRendering(self, enabled):
+        '''
+        Draw the image from OpenGL textures when the viewport is a working
+        QOpenGLWidget, with the raster tiles otherwise. Return True if the
+        textures are used.
+        '''
+        viewport = self.viewport()
+        enabled = enabled and isinstance(viewport, QOpenGLWidget) and viewport.isValid()
+        self.image.setOpenGL(enabled)
+        self.loadPendingLevels()
+        return enabled
+
+    def setRenderMode(self, mode):
+        '''
+        Set the render quality preset: "quality", "balanced" or "speed".
+        '''
+        self.renderPolicy.setMode(mode)
+
+    @Slot(bool)
+    def setFastRendering(self, fast):
+        '''
+        Scale with nearest neighbour, without antialiasing and without saving
+        the painter state between items while fast, smoothly otherwise.
+        '''
+        mode = Qt.FastTransformation if fast else Qt.SmoothTransformation
+        self.image.setTransformationMode(mode)
+        self.compare.setTransformationMode(mode)
+        self.preview.setTransformationMode(mode)
+        self.setRenderHint(QPainter.Antialiasing, not fast)
+        self.setRenderHint(QPainter.SmoothPixmapTransform, not fast)
+        self.setOptimizationFlag(QGraphicsView.DontSavePainterState, fast)
+        self.setOptimizationFlag(QGraphicsView.DontAdjustForAntialiasing, fast)
+
+    def scrollContentsBy(self, dx, dy):
+        if self.scrollBatch is not None:
+            # Both scroll bars of a pan are applied as one scroll by NavigationController.panBy,
+            # a null scroll still updates the mapping for the valueChanged listeners
+            self.scrollBatch += QPoint(dx, dy)
+            super().scrollContentsBy(0, 0)
+            return
+        super().scrollContentsBy(dx, dy)
+
+    def setupViewport(self, viewport):
+        super().setupViewport(viewport)
+        # QOpenGLWidget redraws whole frames anyway, partial updates would only add clipping work
+        self.setViewportUpdateMode(QGraphicsView.FullViewportUpdate if isinstance(viewport, QOpenGLWidget)
+                                   else QGraphicsView.SmartViewportUpdate)
+
+    def wheelEvent(self, event):
+        '''
+        Zoom with wheel, scroll in the grid.
+        '''
+        if self.gridMode:
+            super().wheelEvent(event)
+            return
+        if self.stats:
+            self.stats.inputReceived("wheel")
+        self.navigation.stop()
+        self.zoomController.wheel(event)
         event.accept()
-        super().wheelEvent(event)
 
     def mousePressEvent(self, event):
         '''
         Pan with middle click, draw with left, change brush size with CTRL + left click + horizontal drag.
         '''
+        if self.gridMode and event.buttons() != Qt.MiddleButton:
+            super().mousePressEvent(event)
+            return
+        if self.compareClip.isVisible() and event.buttons() == Qt.LeftButton \
+                and event.modifiers() == Qt.ShiftModifier:
+            self.moveSplit(event.pos())
+            return
         if event.buttons() == Qt.MiddleButton:  # Get pan coordinates reference with middle click
             QApplication.setOverrideCursor(Qt.ClosedHandCursor)
-            self.panReferenceClick = event.pos()
+            self.navigation.beginDrag(event.pos())
         # Get coordinates reference for brush size
         elif event.buttons() == Qt.LeftButton and event.modifiers() == Qt.ControlModifier:
             # Cursor will be drawed below. TO DO need refactoring.
             self.brushReference = event.pos()
         if event.buttons() == Qt.LeftButton:  # Get drawing coordinates reference with left click
+            if event.modifiers() == Qt.NoModifier and self.isDrawable and not self.annotationMode:
+                # Until it is decoded, the stroke is drawn over the reduced image and held
+                self.ensureFullResolution()
             QApplication.setOverrideCursor(self.drawingCursor)
             self.drawReference = self.mapToScene(event.pos())
+            self.strokeRecord = [self.drawReference]
+            self.strokeId += 1
+            self.setBrushOutline(self.drawReference)
         super().mousePressEvent(event)
 
+    def moveSplit(self, position):
+        rect = self.sceneRect()
+        if rect.width() > 0:
+            self.setSplitPosition((self.mapToScene(position).x() - rect.left()) / rect.width())
+
     def mouseReleaseEvent(self, event):
+        if event.button() == Qt.MiddleButton:
+            self.navigation.endDrag()
         QApplication.restoreOverrideCursor()
+        self.setBrushOutline(None)
+        self.commitStroke()
         super().mouseReleaseEvent(event)
 
     def mouseMoveEvent(self, event):
         '''
         Pan with middle click, draw with left, change brush size with CTRL + left click + horizontal drag.
         '''
+        if self.stats:
+            self.stats.inputReceived("mouseMove")
+        if self.gridMode and event.buttons() != Qt.MiddleButton:
+            super().mouseMoveEvent(event)
+            return
+        if self.compareClip.isVisible() and event.buttons() == Qt.LeftButton \
+                and event.modifiers() == Qt.ShiftModifier:
+            self.moveSplit(event.pos())
+            return
         if event.buttons() == Qt.MiddleButton:  # pan with middle click pressed
-            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() +
-                                                (self.panReferenceClick.x() - event.pos().x()))
-            self.verticalScrollBar().setValue(self.verticalScrollBar().value() +
-                                              (self.panReferenceClick.y() - event.pos().y()))
-            self.panReferenceClick = event.pos()
+            self.renderPolicy.interact()
+            self.navigation.drag(event.pos())
         elif event.buttons() == Qt.LeftButton and event.modifiers() == Qt.ControlModifier:
             if event.pos().x() - self.brushReference.x() > 25:
                 self.brushSize += 5
@@ -137,40 +3403,267 @@ class ImageViewer(QGraphicsView):
                 QApplication.restoreOverrideCursor()
                 QApplication.setOverrideCursor(self.drawingCursor)
 
-        if event.buttons() == Qt.LeftButton and self.isDrawable and event.modifiers() == Qt.NoModifier:  # Draw with left click pressed
-            pixmap = self.image.pixmap()
-            self.painter.begin(pixmap)
-            self.painter.setPen(
-                QPen(self.brushColor, self.brushSize, Qt.SolidLine, Qt.RoundCap))
-            self.painter.drawLine(self.drawReference,
-                                  self.mapToScene(event.pos()))
-            self.drawReference = self.mapToScene(event.pos())
-            self.addToUndoStack()
-            self.painter.end()
-            self.image.setPixmap(pixmap)
+        if event.buttons() == Qt.LeftButton and self.isDrawable and event.modifiers() == Qt.NoModifier \
+                and not self.image.isNull() and (self.fullResolutionPending or not self.loader.isLoading()):
+            # Draw with left click pressed
+            self.renderPolicy.interact()
+            self.strokePoints.append(self.mapToScene(event.pos()))
+            self.strokeRecord.append(self.strokePoints[-1])
+            self.setBrushOutline(self.strokePoints[-1])
+            if not self.strokeTimer.isActive():
+                self.strokeTimer.start()
         super().mouseMoveEvent(event)
 
-    def addToUndoStack(self):
-        if len(self.painterStack) > 40:  # Avoid high memory usage
-            self.painterStack = [j for i, j in enumerate(
-                self.painterStack) if i % 2 == 0]
-        self.painterStack.append(self.image.pixmap())
+    def setMaxStrokeFlushRate(self, rate):
+        '''
+        Set the maximum number of times per second the pending stroke points are drawn.
+        '''
+        self.strokeTimer.setInterval(int(1000 / rate))
+
+    def setStrokeSmoothing(self, enabled):
+        '''
+        Draw strokes as quadratic curves through the middle of the mouse positions.
+        '''
+        self.strokeSmoothing = enabled
+
+    def flushStroke(self, final=False):
+        '''
+        Draw the pending stroke points as one path.
+        '''
+        points = self.strokePoints
+        if not points or (self.strokeSmoothing and len(points) < 2 and not final):
+            return
+        path = QPainterPath(self.drawReference)
+        self.strokePoints = []
+        if self.strokeSmoothing:
+            for point, following in zip(points, points[1:]):
+                path.quadTo(point, (point + following) / 2)
+            # The last point is only reached once the next one is known
+            if final:
+                path.lineTo(points[-1])
+            else:
+                self.strokePoints = [points[-1]]
+        else:
+            for point in points:
+                path.lineTo(point)
+        self.drawReference = path.currentPosition()
+        self.strokeLayer.drawPath(path, QPen(self.brushColor, self.brushSize,
+                                             Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+        self.strokeFlushCount += 1
+
+    def commitStroke(self):
+        '''
+        Merge the stroke layer into the image as one undo entry, or into the
+        annotations as a StrokeRecord in annotation mode.
+        '''
+        self.strokeTimer.stop()
+        self.flushStroke(final=True)
+        if self.fullResolutionPending and not self.annotationMode:
+            # Merged by replayHeldStrokes once the full image is displayed
+            if len(self.strokeRecord) > 1:
+                self.heldStrokes.append(StrokeRecord(
+                    self.strokeRecord, self.brushSize, self.brushColor, self.strokeSmoothing))
+            self.strokeRecord = []
+            return
+        rect = self.strokeLayer.dirtyRect
+        if rect.isEmpty():
+            return
+        if self.annotationMode:
+            self.undoHistory.pushAnnotation(self.annotations, StrokeRecord(
+                self.strokeRecord, self.brushSize, self.brushColor, self.strokeSmoothing))
+            self.strokeRecord = []
+            self.strokeLayer.clear()
+            return
+        image = self.image.image()
+        self.undoHistory.beginStroke()
+        self.undoHistory.extendStroke(image, rect)
+        self.strokeLayer.commit(image)
+        self.undoHistory.endStroke(self.strokeId)
+        self.image.updateRegion(rect)
+        self.imageChanged.emit()
+
+    def setUndoMemoryLimit(self, memoryLimit):
+        '''
+        Set the maximum memory in bytes used by the undo history.
+        '''
+        self.undoHistory.setMemoryLimit(memoryLimit)
+
+    def snapshot(self, annotations=True):
+        '''
+        Return a copy of the full resolution image, with the annotations drawn over it.
+        '''
+        self.commitStroke()
+        self.ensureFullResolution(wait=True)
+        # Shares the pixels until the next stroke, which then paints into its own copy
+        image = QImage(self.image.image())
+        if annotations and self.annotations.records and not image.isNull():
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            self.annotations.render(image)
+        return image
+
+    def saveImage(self, path, imageFormat=None, quality=-1, annotations=True):
+        '''
+        Save the image and its annotations in the background and return the job
+        number of the signals of self.exporter. Drawing can go on meanwhile.
+        '''
+        return self.exporter.save(self.snapshot(annotations), path, imageFormat, quality)
+
+    def exportSequence(self, directory, imageFormat="png", quality=-1):
+        '''
+        Convert every image of the sequence to directory in the background, the
+        current one with its drawings and annotations. Return the job number.
+        '''
+        images = {self.imagePath: self.snapshot()} if self.imagePath else {}
+        return self.exporter.exportFiles(self.sequence or [self.imagePath], directory,
+                                         imageFormat, quality, images)
+
+    def setAnnotationMode(self, enabled):
+        '''
+        Keep the new strokes as vector annotations above the image instead of
+        drawing them into its pixels.
+        '''
+        self.commitStroke()
+        self.annotationMode = enabled
+
+    def saveAnnotations(self, path):
+        self.annotations.save(path, self.imagePath, self.sceneRect().size().toSize())
+
+    def loadAnnotations(self, path):
+        '''
+        Display the annotations of a file written by saveAnnotations.
+        '''
+        self.annotations.load(path)
 
     def undo(self):
         '''
-        Undo drawing.
+        Undo the last stroke or annotation.
         '''
-        if self.painterStack:
-            self.image.setPixmap(self.painterStack.pop())
+        self.commitStroke()
+        self.undoHistory.undo()
+        self.imageChanged.emit()
+
+    def redo(self):
+        '''
+        Redo the last undone stroke or annotation.
+        '''
+        self.commitStroke()
+        self.undoHistory.redo()
+        self.imageChanged.emit()
 
     def clear(self):
-        self.image.setPixmap(QPixmap())
-        self.painterStack.clear()
+        self.removeImage()
+        self.undoHistory.clear()
+
+    def removeImage(self):
+        '''
+        Remove the displayed image and its previews, keeping the undo history.
+        '''
+        self.image.setImage(QImage())
+        self.image.setScale(1)
+        self.decodedScale = 1
+        self.strokeLayer.setBounds(QRect())
+        self.preview.setPixmap(QPixmap())
+        self.detail.setPixmap(QPixmap())
 
     def dropEvent(self, event):
         mimeData = event.mimeData()
         if mimeData.hasUrls():
-            self.setImage(mimeData.urls()[0].toLocalFile())
+            paths = [url.toLocalFile() for url in mimeData.urls()]
+            if len(paths) > 1 or os.path.isdir(paths[0]):
+                self.setSequence(paths if len(paths) > 1 else paths[0])
+            else:
+                self.loadImage(paths[0])
 
     def dragEnterEvent(self, event):
         event.acceptProposedAction()
+
+
+class Minimap(QWidget):
+    '''
+    Overview of the image of an ImageViewer with the visible area as a
+    rectangle. Clicking moves the view there at once and dragging the rectangle
+    pans. The overview is scaled from the coarsest pyramid level when the image
+    changes, and scrolling the view only repaints around the rectangle.
+    '''
+
+    def __init__(self, viewer, size=200, parent=None):
+        super().__init__(parent)
+        self.viewer = viewer
+        self.resize(size, size)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.pixmap = QPixmap()
+        self.imageRect = QRectF()
+        self.viewRect = QRectF()
+        self.dragOffset = None
+        viewer.imageChanged.connect(self.refresh)
+        viewer.loader.stripeLoaded.connect(self.refresh)
+        viewer.zoomController.zoomChanged.connect(self.updateViewRect)
+        viewer.horizontalScrollBar().valueChanged.connect(self.updateViewRect)
+        viewer.verticalScrollBar().valueChanged.connect(self.updateViewRect)
+
+    def refresh(self, *args):
+        '''
+        Scale the overview of the image again, after it changed.
+        '''
+        overview = self.viewer.image.overview()
+        if overview.isNull() or self.viewer.sceneRect().isEmpty():
+            self.pixmap = QPixmap()
+            self.imageRect = QRectF()
+        else:
+            self.pixmap = overview.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            self.imageRect = QRectF((self.width() - self.pixmap.width()) / 2,
+                                    (self.height() - self.pixmap.height()) / 2,
+                                    self.pixmap.width(), self.pixmap.height())
+        self.viewRect = self.visibleRect()
+        self.update()
+
+    def visibleRect(self):
+        sceneRect = self.viewer.sceneRect()
+        if self.pixmap.isNull():
+            return QRectF()
+        visible = self.viewer.mapToScene(
+            self.viewer.viewport().rect()).boundingRect().intersected(sceneRect)
+        scale = self.imageRect.width() / sceneRect.width()
+        return QRectF(self.imageRect.topLeft() + (visible.topLeft() - sceneRect.topLeft()) * scale,
+                      visible.size() * scale)
+
+    def updateViewRect(self, *args):
+        rect = self.visibleRect()
+        if rect == self.viewRect:
+            return
+        self.update(self.viewRect.united(rect).toAlignedRect().adjusted(-2, -2, 2, 2))
+        self.viewRect = rect
+
+    def scenePosition(self, position):
+        sceneRect = self.viewer.sceneRect()
+        scale = sceneRect.width() / self.imageRect.width()
+        return sceneRect.topLeft() + (QPointF(position) - self.imageRect.topLeft()) * scale
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), QColor(32, 32, 32))
+        if not self.pixmap.isNull():
+            exposed = QRectF(event.rect()).intersected(self.imageRect)
+            painter.drawPixmap(exposed, self.pixmap, exposed.translated(-self.imageRect.topLeft()))
+            painter.setPen(QPen(QColor(255, 200, 0), 0))
+            painter.drawRect(self.viewRect.adjusted(0, 0, -1, -1))
+        painter.end()
+
+    def mousePressEvent(self, event):
+        if event.button() != Qt.LeftButton or self.pixmap.isNull():
+            return
+        position = QPointF(event.pos())
+        if not self.viewRect.contains(position):
+            self.viewer.navigation.centerOn(self.scenePosition(position), animated=False)
+        self.dragOffset = position - self.viewRect.center()
+
+    def mouseMoveEvent(self, event):
+        if self.dragOffset is not None:
+            self.viewer.navigation.centerOn(
+                self.scenePosition(QPointF(event.pos()) - self.dragOffset), animated=False)
+
+    def mouseReleaseEvent(self, event):
+        self.dragOffset = None
+
+    def resizeEvent(self, event):
+        self.refresh()
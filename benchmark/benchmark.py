@@ -0,0 +1,213 @@
+'''
+MIT License
+
+Copyright (c) 2022 Analyzable
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "example")]
+
+from PySide2 import __version__ as pysideVersion
+from PySide2.QtWidgets import QApplication, QWidget
+from PySide2.QtCore import Qt, QEvent, QPoint, QPointF
+from PySide2.QtGui import QImage, QPainter, QLinearGradient, QColor, QMouseEvent, QWheelEvent
+from ImageViewer import ImageViewer
+
+
+def peakMemory():
+    '''
+    Return the peak resident memory of the process in bytes.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {"median_ms": statistics.median(samples) * 1000,
+            "p95_ms": samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000,
+            "count": len(samples)}
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def makeImage(path, megapixels):
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    image = QImage(width, height, QImage.Format_RGB32)
+    gradient = QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QColor(20, 60, 120))
+    gradient.setColorAt(1, QColor(220, 180, 40))
+    painter = QPainter(image)
+    painter.fillRect(image.rect(), gradient)
+    painter.end()
+    image.save(path, "JPG", 90)
+
+
+def mouse(viewer, kind, position, button, buttons):
+    QApplication.sendEvent(viewer.viewport(), QMouseEvent(
+        kind, QPointF(position), button, buttons, Qt.NoModifier))
+
+
+def wheel(viewer, delta):
+    position = QPointF(viewer.viewport().rect().center())
+    QApplication.sendEvent(viewer.viewport(), QWheelEvent(
+        position, viewer.viewport().mapToGlobal(position.toPoint()), QPoint(), QPoint(0, delta),
+        Qt.NoButton, Qt.NoModifier, Qt.NoScrollPhase, False))
+
+
+def benchmarkSize(app, viewer, path, repeat):
+    results = {}
+
+    samples = []
+    for i in range(repeat):
+        viewer.imageCache.clear()
+        samples.append(timed(viewer.setImage, path))
+        app.processEvents()
+    results["setImage"] = summary(samples)
+
+    # Strokes: cost of one mouse move, of one batch flush and of the commit on release
+    moves, flushes, commits = [], [], []
+    center = viewer.viewport().rect().center()
+    for stroke in range(repeat):
+        mouse(viewer, QEvent.MouseButtonPress, center, Qt.LeftButton, Qt.LeftButton)
+        for i in range(200):
+            position = center + QPoint(int(150 * math.cos(i / 20)), int(100 * math.sin(i / 13)) + stroke)
+            moves.append(timed(mouse, viewer, QEvent.MouseMove, position, Qt.NoButton, Qt.LeftButton))
+            if i % 8 == 7:
+                flushes.append(timed(viewer.flushStroke))
+        commits.append(timed(mouse, viewer, QEvent.MouseButtonRelease, center, Qt.LeftButton, Qt.NoButton))
+    results["strokeMove"] = summary(moves)
+    results["strokeFlush"] = summary(flushes)
+    results["strokeCommit"] = summary(commits)
+    results["undoHistoryBytes"] = viewer.undoHistory.memoryUsage
+
+    # Zoom: one wheel notch animated to the end, with a repaint per frame
+    def zoom(delta):
+        wheel(viewer, delta)
+        while viewer.zoomController.timer.isActive():
+            viewer.zoomController.step()
+            viewer.viewport().repaint()
+    samples = []
+    for i in range(repeat):
+        samples.append(timed(zoom, 120))
+        samples.append(timed(zoom, -120))
+    results["wheelZoom"] = summary(samples)
+
+    # Pan with the middle button, each move followed by a repaint
+    def pan(position):
+        mouse(viewer, QEvent.MouseMove, position, Qt.NoButton, Qt.MiddleButton)
+        viewer.viewport().repaint()
+    viewer.zoomController.zoomActualSize(animated=False)
+    mouse(viewer, QEvent.MouseButtonPress, center, Qt.MiddleButton, Qt.MiddleButton)
+    samples = [timed(pan, center + QPoint(i % 50, i % 30)) for i in range(20 * repeat)]
+    mouse(viewer, QEvent.MouseButtonRelease, center, Qt.MiddleButton, Qt.NoButton)
+    results["pan"] = summary(samples)
+
+    samples = [timed(viewer.undo) for i in range(viewer.undoHistory.index())]
+    results["undo"] = summary(samples or [0])
+    results["peakMemoryBytes"] = peakMemory()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the ratio of every median to the baseline, return False on regressions.
+    '''
+    success = True
+    for size, metrics in results["results"].items():
+        for name, value in metrics.items():
+            reference = baseline.get("results", {}).get(size, {}).get(name)
+            if reference is None:
+                continue
+            current = value["median_ms"] if isinstance(value, dict) else value
+            reference = reference["median_ms"] if isinstance(reference, dict) else reference
+            ratio = current / reference if reference else 1
+            regression = ratio > 1 + tolerance
+            success = success and not regression
+            print("{:>6} {:<18} {:>12.3f} {:>12.3f} {:>7.2f}x{}".format(
+                size, name, reference, current, ratio, "  REGRESSION" if regression else ""),
+                file=sys.stderr)
+    return success
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ImageViewer hot paths.")
+    parser.add_argument("--sizes", default="1,20,100",
+                        help="comma separated image sizes in megapixels")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--viewport", choices=["raster", "opengl"], default="raster",
+                        help="viewport widget, OpenGL needs a working context")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--baseline", help="compare with a previous JSON output")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    app = QApplication([])
+    viewer = ImageViewer()
+    if args.viewport == "raster":
+        viewer.setViewport(QWidget())
+    viewer.resize(1280, 800)
+    viewer.show()
+    app.processEvents()
+
+    results = {"pyside": pysideVersion, "python": platform.python_version(),
+               "platform": platform.platform(), "qpa": app.platformName(),
+               "viewport": args.viewport, "results": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes.split(","):
+            path = os.path.join(directory, "{}MP.jpg".format(size))
+            makeImage(path, float(size))
+            results["results"]["{}MP".format(size)] = benchmarkSize(app, viewer, path, args.repeat)
+            viewer.clear()
+            viewer.imageCache.clear()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            sys.exit(0 if compare(results, json.load(file), args.tolerance) else 1)
+
+
+if __name__ == '__main__':
+    main()
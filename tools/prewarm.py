@@ -0,0 +1,56 @@
+'''
+MIT License
+
+Copyright (c) 2022 Analyzable
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import argparse
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "example")]
+
+from PySide2.QtGui import QGuiApplication
+from ImageViewer import DiskCache, imageSequence, prewarm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store the pyramid levels of images in the viewer disk cache.")
+    parser.add_argument("sources", nargs="+",
+                        help="image files, directories or glob patterns")
+    parser.add_argument("--directory", help="cache directory, the user cache by default")
+    parser.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024 * 1024)
+    args = parser.parse_args()
+
+    app = QGuiApplication([])
+    cache = DiskCache(args.directory, args.max_bytes)
+    for source in args.sources:
+        paths = imageSequence(source) if os.path.isdir(source) or not os.path.exists(source) else [source]
+        prewarm(paths, cache)
+        print("{}: {} images".format(source, len(paths)))
+
+
+if __name__ == '__main__':
+    main()